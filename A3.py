@@ -5,38 +5,66 @@ A3 Report Assistant – Word Edition v1.0.0
 * 支持AJAX无刷新文件下载和生成进度提示
 * 防重复点击机制和任务去重保护
 * 基于DeepSeek AI的智能A3报告生成
-* 依赖：flask python-docx openai waitress
+* 依赖：flask python-docx openai waitress（异步服务另需 uvicorn a2wsgi）
 """
 
 from __future__ import annotations
 import datetime as _dt
+import argparse
+import asyncio
+import csv
+import hashlib
+import hmac
+import io
 import json
+import math
 import re
+import inspect
+import sqlite3
+import struct
 import sys
 import os
+import random
+import threading
+import time
+
+_MODULE_STARTED = time.perf_counter()
+
+import uuid
 import webbrowser
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from types import MappingProxyType
 from pathlib import Path
-from typing import Dict, List
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Tuple
+from urllib.parse import quote
 
 from flask import (
     Flask,
+    Response,
     request,
     render_template,
     render_template_string,
-    send_file,
     redirect,
     url_for,
     flash,
+    g,
+    has_request_context,
     jsonify,
     session,
+    stream_with_context,
 )
-import openai
-from docx import Document
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
-from docx.oxml.ns import qn
 
 import config
 
+# openai / httpx / python-docx 导入较慢，改为首次使用时导入，并在启动后由后台预热线程提前加载
+if TYPE_CHECKING:
+    import openai
+    from docx import Document
+
 def ensure_api_key():
     """检查API Key是否存在，Docker环境下跳过交互式输入"""
     api_key = os.getenv("DEEPSEEK_API_KEY") or getattr(config, "DEEPSEEK_API_KEY", None)
@@ -106,24 +134,156 @@ def ensure_api_key():
 # -------------------------------------------------------------
 OUTPUT_DIR = Path(__file__).parent / config.OUTPUT_DIR_NAME
 OUTPUT_DIR.mkdir(exist_ok=True)
+# SQLite 状态与缓存库所在目录；输出目录在网络文件系统上时应指向本地磁盘
+STATE_DIR = Path(__file__).parent / config.STATE_DIR if config.STATE_DIR else OUTPUT_DIR
+STATE_DIR.mkdir(parents=True, exist_ok=True)
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """某一时刻的完整业务配置（只读）：步骤提示词预先拼好，重新加载时整体替换
+
+    每个 Web 请求开始时取一次快照，后台任务在提交时取快照，处理过程中不会看到新旧配置混杂。
+    """
+
+    api_key: str
+    base_url: str
+    model_name: str
+    guide: Tuple[Mapping[str, str], ...]
+    guide_map: Mapping[str, Mapping[str, str]]
+    prompts: Mapping[str, str]
+    step_prompts: Mapping[str, str]
+    doc_font_name: str
+    doc_title_template: str
+    validate_token_budget: int
+    generation_mode: str
+    similarity_threshold: float
+    step_rules: Mapping[str, Mapping[str, object]]
+    fingerprint: str
+
+
+def compile_step_rules(rules: Dict[str, Dict[str, object]]) -> Mapping[str, Mapping[str, object]]:
+    """预编译 STEP_RULES 中各要素的正则；无效的正则按普通文本匹配"""
+    compiled = {}
+    for step_id, step_rules in rules.items():
+        items = {}
+        for name, value in step_rules.items():
+            if isinstance(value, list):
+                value = tuple(
+                    (item["name"], compile_rule_pattern(item["pattern"]))
+                    for item in value
+                    if isinstance(item, dict) and item.get("name") and item.get("pattern")
+                )
+            items[name] = value
+        compiled[step_id] = MappingProxyType(items)
+    return MappingProxyType(compiled)
+
+
+def compile_rule_pattern(pattern: str) -> "re.Pattern":
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except re.error as exc:
+        print(f"本地预检规则的正则无效，按普通文本匹配: {pattern!r}（{exc}）")
+        return re.compile(re.escape(pattern), re.IGNORECASE)
+
+
+def build_config_snapshot() -> ConfigSnapshot:
+    guide = tuple(MappingProxyType(dict(st)) for st in config.GUIDE)
+    prompts = dict(config.SYSTEM_PROMPTS)
+    model = config.SUPPORTED_MODELS.get(config.MODEL_NAME, {})
+    payload = json.dumps({"prompts": prompts, "guide": config.GUIDE}, ensure_ascii=False, sort_keys=True)
+    return ConfigSnapshot(
+        # 优先从环境变量读取 API Key，用于Docker部署
+        api_key=os.getenv("DEEPSEEK_API_KEY") or config.DEEPSEEK_API_KEY,
+        base_url=config.DEEPSEEK_BASE_URL,
+        model_name=config.MODEL_NAME,
+        guide=guide,
+        guide_map=MappingProxyType({st["id"]: st for st in guide}),
+        prompts=MappingProxyType(prompts),
+        step_prompts=MappingProxyType({
+            st["id"]: prompts["step_guidance"].format(
+                title=st['title'],
+                purpose=st['purpose'],
+                tools=st['tools'],
+                focus=st['focus']
+            )
+            for st in guide
+        }),
+        doc_font_name=config.DOC_FONT_NAME,
+        doc_title_template=config.DOC_TITLE_TEMPLATE,
+        # 当前模型的 AI 检查提示词预算，未单独配置的模型使用 VALIDATE_TOKEN_BUDGET
+        validate_token_budget=int(model.get("validate_token_budget", config.VALIDATE_TOKEN_BUDGET)),
+        generation_mode=config.GENERATION_MODE if config.GENERATION_MODE in GENERATION_MODES else "per_step",
+        similarity_threshold=min(1.0, max(0.0, config.SIMILARITY_THRESHOLD)),
+        step_rules=compile_step_rules(getattr(config, "STEP_RULES", {})),
+        # 系统提示词与 A3 步骤定义的指纹，任一变化都会产生新值
+        fingerprint=hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16],
+    )
+
+
+# 生成报告的方式：per_step 每个步骤单独调用；structured 一次调用返回所有步骤的 JSON，缺失或无效的步骤再单独调用
+GENERATION_MODES = ("per_step", "structured")
+
+_config_snapshot = build_config_snapshot()
+_config_local = threading.local()
+
+
+def current_config() -> ConfigSnapshot:
+    """当前请求 / 后台任务绑定的配置快照，未绑定时使用最新快照"""
+    bound = getattr(_config_local, "snapshot", None)
+    if bound is not None:
+        return bound
+    if has_request_context() and "config_snapshot" in g:
+        return g.config_snapshot
+    return _config_snapshot
+
+
+@contextmanager
+def use_config(snapshot: ConfigSnapshot):
+    """在当前线程内固定使用指定快照（用于线程池中的后台任务）"""
+    previous = getattr(_config_local, "snapshot", None)
+    _config_local.snapshot = snapshot
+    try:
+        yield snapshot
+    finally:
+        _config_local.snapshot = previous
 
-# 从config导入配置
-GUIDE: List[Dict[str, str]] = config.GUIDE
-# 优先从环境变量读取 API Key，用于Docker部署
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY") or config.DEEPSEEK_API_KEY
 
-GUIDE_MAP = {g["id"]: g for g in GUIDE}
+def run_with_config(snapshot: ConfigSnapshot, func, *args, **kwargs):
+    with use_config(snapshot):
+        return func(*args, **kwargs)
 
 app = Flask(__name__, template_folder='templates')
 app.secret_key = config.APP_SECRET_KEY
 
-# 全局变量：存储正在生成报告的标识
-generating_reports = set()
+# 全局线程池：限制同时进行的 LLM 调用数量
+llm_executor = ThreadPoolExecutor(
+    max_workers=max(1, config.LLM_MAX_CONCURRENCY),
+    thread_name_prefix="a3-llm",
+)
+
+# 后台任务线程池：在 Web 请求之外执行报告生成
+job_executor = ThreadPoolExecutor(
+    max_workers=max(1, config.REPORT_JOB_WORKERS),
+    thread_name_prefix="a3-job",
+)
+
+# 报告落盘线程：异步写入报告存储，不占用生成和下载路径
+persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="a3-persist")
+
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
 
 # -------------------------------------------------------------
 # Helper functions
 # -------------------------------------------------------------
 
+def client_id() -> str:
+    """当前浏览器会话的匿名标识，用于按用户隔离草稿等服务端状态"""
+    if "client_id" not in session:
+        session["client_id"] = uuid.uuid4().hex
+    return session["client_id"]
+
 def require_access(f):
     """访问权限验证装饰器"""
     from functools import wraps
@@ -135,17 +295,78 @@ def require_access(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def reload_config():
-    """重新加载配置文件"""
+def reload_config(from_disk: bool = False):
+    """重新加载配置文件
+
+    from_disk=True 用于其它进程保存配置后的重新加载：管理后台可修改的配置项以 .env 中的新值为准。
+    """
     import importlib
     # 重新加载 .env 文件中的环境变量
-    config.load_env_file()
+    config.load_env_file(override=ADMIN_ENV_KEYS if from_disk else ())
     # 重新加载 config 模块
     importlib.reload(config)
-    global GUIDE, GUIDE_MAP, DEEPSEEK_API_KEY
-    GUIDE = config.GUIDE
-    GUIDE_MAP = {g["id"]: g for g in GUIDE}
-    DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY") or config.DEEPSEEK_API_KEY
+    # 新快照构建完成后一次性替换，正在处理的请求继续使用各自的旧快照
+    global _config_snapshot
+    _config_snapshot = build_config_snapshot()
+    # 提示词或步骤定义变化时，旧的缓存结果随之失效
+    llm_cache.set_version(_config_snapshot.fingerprint)
+    similarity_index.set_version(_config_snapshot.fingerprint)
+    config_watcher.mark_current()
+
+
+class ConfigWatcher:
+    """多进程部署时，管理后台保存配置只会在处理该请求的进程内重新加载；
+    其它进程在处理请求前检查 .env 和 config.py 是否被改写（最多每秒一次），有变化时重新加载。
+    """
+
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, paths: List[Path]):
+        self.paths = paths
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._signature = self._stat()
+
+    def _stat(self) -> Tuple:
+        signature = []
+        for path in self.paths:
+            try:
+                st = path.stat()
+                signature.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def mark_current(self) -> None:
+        with self._lock:
+            self._signature = self._stat()
+
+    def check(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.CHECK_INTERVAL
+            signature = self._stat()
+            if signature == self._signature:
+                return
+            self._signature = signature
+        print("检测到配置文件已更新，重新加载配置")
+        try:
+            reload_config(from_disk=True)
+        except Exception as exc:
+            print(f"重新加载配置失败，继续使用当前配置: {exc}")
+
+
+config_watcher = ConfigWatcher([Path(config.__file__).resolve(), Path(config.__file__).resolve().parent / ".env"])
+
+# 管理后台可修改、保存到 .env 的配置项
+ADMIN_ENV_KEYS = (
+    "DEEPSEEK_API_KEY", "DEEPSEEK_BASE_URL", "MODEL_NAME", "DOC_FONT_NAME", "DOC_TITLE_TEMPLATE",
+    "WEB_ACCESS_PASSWORD", "GENERATION_MODE", "SIMILARITY_THRESHOLD",
+)
 
 def save_config_to_env(key, value):
     """更新 .env 文件中的单个配置项"""
@@ -191,6 +412,8 @@ def save_config(new_config):
             "DOC_FONT_NAME": new_config.get("doc_font_name", ""),
             "DOC_TITLE_TEMPLATE": new_config.get("doc_title_template", ""),
             "WEB_ACCESS_PASSWORD": new_config.get("web_access_password", ""),
+            "GENERATION_MODE": new_config.get("generation_mode", ""),
+            "SIMILARITY_THRESHOLD": parse_similarity_threshold(new_config.get("similarity_threshold", "")),
         }
         
         for key, value in env_configs.items():
@@ -202,7 +425,7 @@ def save_config(new_config):
             content = f.read()
         
         # 更新系统提示词
-        for key in ["default", "step_guidance", "validation", "optimization"]:
+        for key in ["default", "step_guidance", "validation", "optimization", "structured"]:
             pattern = f'"{key}": """.*?"""'
             prompt_key = f"system_prompt_{key}"
             prompt_content = new_config.get(prompt_key, "")
@@ -237,6 +460,25 @@ def save_config(new_config):
                 content,
                 flags=re.DOTALL
             )
+
+            # 更新本地预检规则（与步骤一一对应，无效的 JSON 保留原规则）
+            step_rules_raw = new_config.getlist("step_rules[]")
+            if len(step_rules_raw) == len(step_ids):
+                rules = {}
+                for step_id, raw in zip(step_ids, step_rules_raw):
+                    parsed = parse_step_rules(raw)
+                    if parsed is None:
+                        print(f"警告: 步骤 {step_id} 的本地预检规则不是有效的 JSON，保留原规则")
+                        parsed = config.STEP_RULES.get(step_id)
+                    if parsed:
+                        rules[step_id] = parsed
+                rules_content = "STEP_RULES = " + json.dumps(rules, ensure_ascii=False, indent=4)
+                content = re.sub(
+                    r'STEP_RULES = \{.*?\n\}',
+                    lambda m: rules_content,
+                    content,
+                    flags=re.DOTALL
+                )
         
         with open("config.py", "w", encoding="utf-8") as f:
             f.write(content)
@@ -246,76 +488,526 @@ def save_config(new_config):
         print(f"保存配置失败: {e}")
         return False
 
+def parse_similarity_threshold(raw: str) -> str:
+    """管理后台提交的相似度阈值：限制在 0~1 之间；留空或不是数字时保留原值"""
+    raw = (raw or "").strip()
+    if not raw:
+        return str(config.SIMILARITY_THRESHOLD)
+    try:
+        value = float(raw)
+    except ValueError:
+        value = float("nan")
+    if value != value:
+        print(f"警告: 相似度阈值 {raw!r} 不是有效的数字，保留原值")
+        return str(config.SIMILARITY_THRESHOLD)
+    return str(min(1.0, max(0.0, value)))
+
+
+def parse_step_rules(raw: str) -> Optional[Dict[str, object]]:
+    """解析管理后台提交的单个步骤规则；只保留数字和 {"name", "pattern"} 列表，无效时返回 None"""
+    if not raw.strip():
+        return {}
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    rules = {}
+    for name, value in data.items():
+        if isinstance(value, int) and not isinstance(value, bool):
+            rules[name] = value
+        elif isinstance(value, list):
+            rules[name] = [
+                {"name": str(item["name"]), "pattern": str(item["pattern"])}
+                for item in value
+                if isinstance(item, dict) and item.get("name") and item.get("pattern")
+            ]
+    return rules
+
 def sanitize_filename(text: str) -> str:
     return re.sub(r"[^\w\- ]", "", text).strip()[:40] or "A3Report"
 
 
-def next_docx_path(topic: str) -> Path:
-    base = f"{_dt.datetime.now():%Y%m%d_%H%M}_{sanitize_filename(topic)}"
-    idx = 1
-    while True:
-        p = OUTPUT_DIR / f"{base}_v{idx}.docx"
-        if not p.exists():
-            return p
-        idx += 1
-
-
-def call_deepseek(prompt: str, api_key: str = None, step_id: str = None) -> str:
-    api_key = api_key or DEEPSEEK_API_KEY
-    # 如果有step_id，拼接system prompt
-    if step_id and step_id in GUIDE_MAP:
-        st = GUIDE_MAP[step_id]
-        sys_prompt = config.SYSTEM_PROMPTS["step_guidance"].format(
-            title=st['title'],
-            purpose=st['purpose'],
-            tools=st['tools'],
-            focus=st['focus']
-        )
-        messages = [
-            {"role": "system", "content": sys_prompt},
+def report_filename(topic: str) -> str:
+    return f"{_dt.datetime.now():%Y%m%d_%H%M}_{sanitize_filename(topic)}.docx"
+
+
+CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+CONTEXT_MIN_TOKENS = 40  # 截断后仍值得发送的最短内容
+
+def estimate_tokens(text: str) -> int:
+    """本地估算 token 数：中文约 0.6 token/字，其它字符约 0.3 token/字"""
+    cjk = len(CJK_RE.findall(text))
+    return int(cjk * 0.6 + (len(text) - cjk) * 0.3) + 1
+
+
+def messages_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(msg["content"]) + 4 for msg in messages)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep = max(1, int(len(text) * max_tokens / tokens) - 1)
+    return text[:keep] + "…"
+
+
+def build_validation_messages(step_id: str, inputs: Dict[str, str], history: List[Dict[str, str]],
+                              findings: List[str] = None) -> List[Dict[str, str]]:
+    """构造 AI 检查 / 追问的消息列表：步骤指导 + 已填写内容 + 本地预检发现 + 历史对话
+
+    固定的指导和检查要求放在前面、已填写内容放在最后，便于命中模型服务端的前缀缓存。
+
+    总长度受当前模型的 token 预算约束：历史对话优先保留最近几轮，较早的轮次压缩为摘要；
+    已填写内容优先保留当前步骤及相邻步骤，距离较远的步骤按剩余预算截断或省略。
+    """
+    cfg = current_config()
+    budget = cfg.validate_token_budget
+    title = cfg.guide_map[step_id]['title']
+    sys_prompt = cfg.step_prompts[step_id]
+    notes = ""
+    if findings:
+        notes = "\n\n本地规则检查发现以下缺口，请在建议中一并说明：\n" + "\n".join(f"- {f}" for f in findings)
+    fixed = estimate_tokens(sys_prompt) + estimate_tokens(
+        cfg.prompts["validation"].format(context="", title=title)
+    ) + estimate_tokens(notes) + 8
+
+    history = [
+        {"role": msg["role"], "content": msg["content"]}
+        for msg in history
+        if isinstance(msg, dict) and msg.get("role") in ("user", "assistant")
+        and isinstance(msg.get("content"), str) and msg["content"]
+    ]
+    # 历史对话（含摘要）最多占用剩余预算的一半
+    history_budget = max(0, budget - fixed) // 2
+    kept, dropped = split_recent_history(history, history_budget)
+    summary = summarize_history(
+        dropped, min(config.HISTORY_SUMMARY_TOKENS, history_budget - messages_tokens(kept))
+    )
+    context_budget = budget - fixed - messages_tokens(kept) - estimate_tokens(summary)
+    context = build_context(step_id, inputs, context_budget)
+    user_prompt = cfg.prompts["validation"].format(
+        context=context + notes + summary,
+        title=title
+    )
+    messages = [
+        {"role": "system", "content": sys_prompt},
+        {"role": "user", "content": user_prompt}
+    ] + kept
+    print(
+        f"[validate] {step_id} 提示词约 {messages_tokens(messages)} tokens（预算 {budget}），"
+        f"历史保留 {len(kept)}/{len(history)} 条"
+    )
+    return messages
+
+
+def build_context(step_id: str, inputs: Dict[str, str], budget: int) -> str:
+    """按与当前步骤的相关度分配预算，输出仍保持 GUIDE 顺序"""
+    cfg = current_config()
+    position = {g["id"]: idx for idx, g in enumerate(cfg.guide)}
+    filled = {
+        k: f"{cfg.guide_map[k]['title']}: {v}"
+        for k, v in inputs.items()
+        if k in cfg.guide_map and isinstance(v, str) and v.strip()
+    }
+    ranked = sorted(filled, key=lambda k: (k != step_id, abs(position[k] - position[step_id])))
+    lines: Dict[str, str] = {}
+    remaining = budget
+    for k in ranked:
+        cost = estimate_tokens(filled[k])
+        if cost <= remaining:
+            lines[k] = filled[k]
+            remaining -= cost
+        elif k == step_id or remaining >= CONTEXT_MIN_TOKENS:
+            # 当前步骤始终保留，预算不足时截断
+            allowed = max(remaining, CONTEXT_MIN_TOKENS)
+            lines[k] = truncate_to_tokens(filled[k], allowed)
+            remaining -= allowed
+    return "\n".join(lines[g["id"]] for g in cfg.guide if g["id"] in lines)
+
+
+def split_recent_history(history: List[Dict[str, str]], budget: int):
+    """从最新一条往前保留，超出预算的较早消息返回给摘要；最新一条始终保留"""
+    kept: List[Dict[str, str]] = []
+    used = 0
+    for index in range(len(history) - 1, -1, -1):
+        msg = history[index]
+        cost = estimate_tokens(msg["content"]) + 4
+        if kept and used + cost > budget:
+            break
+        if not kept and cost > budget:
+            msg = {"role": msg["role"], "content": truncate_to_tokens(msg["content"], max(budget, CONTEXT_MIN_TOKENS))}
+        kept.insert(0, msg)
+        used += cost
+    dropped = history[:len(history) - len(kept)]
+    # 有消息被压缩时，保留部分以顾问回复开头，保证 user / assistant 交替
+    while dropped and len(kept) > 1 and kept[0]["role"] == "user":
+        dropped.append(kept.pop(0))
+    return kept, dropped
+
+
+def summarize_history(dropped: List[Dict[str, str]], max_tokens: int) -> str:
+    if not dropped or max_tokens < CONTEXT_MIN_TOKENS:
+        return ""
+    lines = [
+        f"- {'用户' if msg['role'] == 'user' else '顾问'}：{truncate_to_tokens(msg['content'], 60)}"
+        for msg in dropped
+    ]
+    # 摘要过长时只保留较新的部分
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n\n此前对话摘要：\n" + "\n".join(lines)
+
+
+def prompt_messages(prompt: str, step_id: str = None) -> List[Dict[str, str]]:
+    cfg = current_config()
+    # 如果有step_id，使用该步骤的system prompt
+    if step_id and step_id in cfg.step_prompts:
+        return [
+            {"role": "system", "content": cfg.step_prompts[step_id]},
             {"role": "user", "content": prompt},
         ]
-        return call_deepseek_multi(messages, api_key)
     # 否则用默认system prompt
-    client = openai.OpenAI(api_key=api_key, base_url=config.DEEPSEEK_BASE_URL)
+    return [
+        {"role": "system", "content": cfg.prompts["default"]},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def call_deepseek(prompt: str, api_key: str = None, step_id: str = None,
+                  priority: int = None, owner: str = None) -> str:
+    api_key = api_key or current_config().api_key
+    return call_deepseek_multi(
+        prompt_messages(prompt, step_id), api_key, step_id=step_id, priority=priority, owner=owner
+    )
+
+
+def optimization_prompt(st: Dict[str, str], content: str) -> str:
+    return current_config().prompts["optimization"].format(
+        title=st['title'],
+        content=content
+    )
+
+
+def optimize_steps(user_inputs: Dict[str, str], on_step_done=None, draft_id: str = None) -> Dict[str, str]:
+    """并发优化各步骤内容，结果按 GUIDE 顺序返回，单步失败不影响其它步骤（失败的步骤不在结果中）
+
+    on_step_done(step_id, state) 会在每个步骤完成时（按完成先后）被调用，用于汇报进度，
+    state 为 "done" / "failed" / "reused" / "similar"。
+    指定 draft_id 时，内容、提示词和步骤定义都未变化的步骤直接复用草稿中保存的建议；
+    开启相似步骤复用时，与以往生成过的步骤内容相似度达到阈值的直接复用当时的建议（similar）。
+    structured 模式下先一次调用生成所有待生成的步骤，缺失或无效的步骤再逐个调用。
+    """
+    cfg = current_config()
+    futures = {}
+    fingerprints = {}
+    # 相似步骤复用开启时才计算签名，每个步骤只算一次，查询和生成后写入索引共用
+    sketches = {}
+    suggestions: Dict[str, str] = {}
+    pending = []
+    for st in cfg.guide:
+        content = user_inputs.get(st["id"], "")
+        if not content:
+            continue
+        prompt = optimization_prompt(st, content)
+        if draft_id:
+            fingerprints[st["id"]] = step_fingerprint(prompt_messages(prompt, st["id"]))
+            reused = draft_store.get(draft_id, st["id"], fingerprints[st["id"]])
+            if reused is not None:
+                suggestions[st["id"]] = reused
+                if on_step_done is not None:
+                    on_step_done(st["id"], "reused")
+                continue
+        if cfg.similarity_threshold > 0:
+            sketches[st["id"]] = similarity_index.sketch(content)
+            similar = similarity_index.lookup(st["id"], sketches[st["id"]], cfg.similarity_threshold)
+            if similar is not None:
+                suggestions[st["id"]] = similar
+                if draft_id:
+                    draft_store.put(draft_id, st["id"], fingerprints[st["id"]], similar)
+                if on_step_done is not None:
+                    on_step_done(st["id"], "similar")
+                continue
+        pending.append((st, prompt))
+    reused_count = len(suggestions)
+
+    if cfg.generation_mode == "structured" and len(pending) > 1:
+        generated = structured_suggestions([st for st, _ in pending], user_inputs, owner=draft_id)
+        for step_id, text in generated.items():
+            suggestions[step_id] = text
+            if step_id in sketches:
+                similarity_index.add(step_id, user_inputs[step_id], text, sketches[step_id])
+            if draft_id:
+                draft_store.put(draft_id, step_id, fingerprints[step_id], text)
+            if on_step_done is not None:
+                on_step_done(step_id, "done")
+
+    for st, prompt in pending:
+        if st["id"] in suggestions:
+            continue
+        # 草稿ID即提交者的 client_id，调度器据此在不同用户的报告之间轮流放行
+        future = llm_executor.submit(
+            run_with_config, cfg, call_deepseek, prompt,
+            step_id=st["id"], priority=PRIORITY_GENERATE, owner=draft_id,
+        )
+        if on_step_done is not None:
+            future.add_done_callback(
+                lambda f, step_id=st["id"]: on_step_done(step_id, "done" if _step_succeeded(f) else "failed")
+            )
+        futures[st["id"]] = future
+
+    for st in cfg.guide:
+        if st["id"] in suggestions:
+            continue
+        future = futures.get(st["id"])
+        if future is None:
+            suggestions[st["id"]] = "(用户未填写)"
+            continue
+        try:
+            suggestions[st["id"]] = future.result()
+        except Exception:
+            # 失败的步骤不返回建议，报告中显示占位说明，进度中标记为 failed
+            continue
+        if st["id"] in sketches:
+            similarity_index.add(st["id"], user_inputs[st["id"]], suggestions[st["id"]], sketches[st["id"]])
+        if draft_id:
+            draft_store.put(draft_id, st["id"], fingerprints[st["id"]], suggestions[st["id"]])
+    draft_store.record(reused=reused_count, called=len(pending))
+    return {st["id"]: suggestions[st["id"]] for st in cfg.guide if st["id"] in suggestions}
+
+
+def structured_messages(steps, user_inputs: Dict[str, str]) -> List[Dict[str, str]]:
+    cfg = current_config()
+    blocks = []
+    for st in steps:
+        blocks.append(
+            f"[{st['id']}] {st['title']}\n"
+            f"目的：{st['purpose']}；工具：{st['tools']}；要点：{st['focus']}\n"
+            f"内容：{user_inputs[st['id']]}"
+        )
+    return [
+        {"role": "system", "content": cfg.prompts["default"]},
+        {"role": "user", "content": cfg.prompts["structured"].format(steps="\n\n".join(blocks))},
+    ]
+
+
+def structured_suggestions(steps, user_inputs: Dict[str, str], owner: str = None) -> Dict[str, str]:
+    """一次调用生成多个步骤的建议，只返回校验通过的步骤（步骤ID在请求范围内且值为非空字符串）"""
+    messages = structured_messages(steps, user_inputs)
     try:
-        resp = client.chat.completions.create(
-            model=config.MODEL_NAME,
-            messages=[
-                {"role": "system", "content": config.SYSTEM_PROMPTS["default"]},
-                {"role": "user", "content": prompt},
-            ],
-            stream=False,
+        reply = call_deepseek_multi(
+            messages, step_id="structured", priority=PRIORITY_GENERATE, owner=owner,
+            response_format={"type": "json_object"},
         )
-        return resp.choices[0].message.content.strip()
-    except Exception as exc:
-        return f"<LLM 调用失败> {exc}"
+    except LLMCallError as exc:
+        print(f"结构化生成失败，改为逐步骤生成: {exc}")
+        STRUCTURED_STEPS.inc(len(steps), result="fallback")
+        return {}
+    try:
+        data = json.loads(reply)
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        # 无效回复不留在缓存中，下次仍然重新请求
+        llm_cache.discard(messages)
+        print("结构化生成返回的不是 JSON 对象，改为逐步骤生成")
+        STRUCTURED_STEPS.inc(len(steps), result="fallback")
+        return {}
+    result = {}
+    for st in steps:
+        value = data.get(st["id"])
+        if isinstance(value, str) and value.strip():
+            result[st["id"]] = value.strip()
+    STRUCTURED_STEPS.inc(len(result), result="ok")
+    if len(result) < len(steps):
+        missing = [st["id"] for st in steps if st["id"] not in result]
+        STRUCTURED_STEPS.inc(len(missing), result="fallback")
+        print(f"结构化生成缺少或无效的步骤 {missing}，改为逐步骤生成")
+    return result
 
 
-def build_doc(topic: str, user_inputs: Dict[str, str], suggestions: Dict[str, str]) -> Path:
-    doc = Document()
-    h = doc.add_heading(config.DOC_TITLE_TEMPLATE.format(topic=topic), level=1)
+def _step_succeeded(future) -> bool:
+    return future.exception() is None
+
+
+def step_fingerprint(messages: List[Dict[str, str]]) -> str:
+    """步骤优化请求的指纹：内容、步骤定义、提示词或模型任一变化都会改变"""
+    payload = json.dumps([current_config().model_name, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# AI 建议生成失败的步骤在报告中显示的说明，不把异常信息写进报告
+SUGGESTION_UNAVAILABLE = "（本步骤的 AI 建议暂时无法生成，可稍后重新生成报告）"
+
+def render_doc(topic: str, user_inputs: Dict[str, str], suggestions: Dict[str, str]) -> Document:
+    with RENDER_DOC_SECONDS.time():
+        return _render_doc(topic, user_inputs, suggestions)
+
+
+def _render_doc(topic: str, user_inputs: Dict[str, str], suggestions: Dict[str, str]) -> Document:
+    from docx import Document
+    from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+
+    # 字体已在模板样式中统一设置，这里无需逐个 run 设置字体
+    cfg = current_config()
+    template, style_ids = doc_template()
+    doc = Document(io.BytesIO(template))
+    h = add_text_paragraph(doc, cfg.doc_title_template.format(topic=topic), style_ids["Heading 1"])
     h.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    for run in h.runs:
-        set_font_simsun(run)
-
-    for idx, st in enumerate(GUIDE, 1):
-        heading = doc.add_heading(f"Step {idx}: {st['title']}", level=2)
-        for run in heading.runs:
-            set_font_simsun(run)
-        p1 = doc.add_paragraph(user_inputs.get(st["id"], "(用户未填写)"))
-        for run in p1.runs:
-            set_font_simsun(run)
-        p2 = doc.add_paragraph("优化建议：", style="Intense Quote")
-        for run in p2.runs:
-            set_font_simsun(run)
-        p3 = doc.add_paragraph(suggestions.get(st["id"], "-"))
-        for run in p3.runs:
-            set_font_simsun(run)
-
-    path = next_docx_path(topic)
-    doc.save(path)
-    return path
+
+    for idx, st in enumerate(cfg.guide, 1):
+        add_text_paragraph(doc, f"Step {idx}: {st['title']}", style_ids["Heading 2"])
+        add_text_paragraph(doc, user_inputs.get(st["id"], "(用户未填写)"))
+        add_text_paragraph(doc, "优化建议：", style_ids["Intense Quote"])
+        add_text_paragraph(doc, suggestions.get(st["id"], SUGGESTION_UNAVAILABLE))
+    return doc
+
+
+def add_text_paragraph(doc: Document, text: str, style_id: str = None):
+    """直接写入样式 ID 和按行拆分的 w:t / w:br / w:tab，避免 python-docx 逐字符处理长文本"""
+    paragraph = doc.add_paragraph()
+    if style_id:
+        paragraph._p.style = style_id
+    r = paragraph.add_run()._r
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    for line_no, line in enumerate(lines):
+        if line_no:
+            r.add_br()
+        for seg_no, segment in enumerate(line.split("\t")):
+            if seg_no:
+                r.add_tab()
+            if segment:
+                r.add_t(segment)
+    return paragraph
+
+
+def doc_to_bytes(doc: Document) -> bytes:
+    """在内存中序列化 Word 文档，无需经过磁盘"""
+    buffer = io.BytesIO()
+    with DOC_SAVE_SECONDS.time(target="memory"):
+        doc.save(buffer)
+    return buffer.getvalue()
+
+
+def docx_response(data: bytes, filename: str) -> Response:
+    """直接从内存返回 Word 文档，带正确的 Content-Length 和文件名"""
+    ascii_name = filename.encode("ascii", "ignore").decode() or "A3Report.docx"
+    resp = Response(data, mimetype=DOCX_MIMETYPE)
+    resp.headers["Content-Length"] = str(len(data))
+    resp.headers["Content-Disposition"] = (
+        f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+    )
+    return resp
+
+# -------------------------------------------------------------
+# 报告生成任务
+# -------------------------------------------------------------
+
+def report_dedupe_key(user_inputs: Dict[str, str]) -> str:
+    """按规范化后的填写内容、模型和提示词版本计算去重键"""
+    normalized = {
+        step_id: "\n".join(line.rstrip() for line in text.replace("\r\n", "\n").split("\n")).strip()
+        for step_id, text in sorted(user_inputs.items())
+    }
+    payload = json.dumps(
+        [normalized, current_config().model_name, current_config().fingerprint],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# 可以下载报告的任务状态；partial 表示部分步骤的 AI 建议生成失败
+REPORT_READY_STATUSES = ("done", "partial")
+
+
+def submit_report_job(user_inputs: Dict[str, str], draft_id: str = None):
+    """登记报告生成任务并交给后台线程池执行，立即返回 (任务ID, 是否复用了已有任务)
+
+    相同内容的任务正在进行或刚刚完成时，直接复用该任务而不再重复调用 LLM。
+    任务状态保存在共享的 SQLite 中，多个进程 / 容器都能查询和复用。
+    """
+    key = report_dedupe_key(user_inputs)
+    cfg = current_config()
+    steps = {
+        st["id"]: "pending" if user_inputs.get(st["id"]) else "skipped"
+        for st in cfg.guide
+    }
+    job_id, coalesced = job_store.submit(key, steps, user_inputs.get("step1", "A3_Topic")[:30])
+    if not coalesced:
+        # 任务使用提交时的配置快照，执行期间修改配置不影响本任务
+        job_executor.submit(run_with_config, cfg, run_report_job, job_id, user_inputs, draft_id)
+    return job_id, coalesced
+
+
+def run_report_job(job_id: str, user_inputs: Dict[str, str], draft_id: str = None) -> None:
+    job = job_store.get(job_id)
+    job_store.update(job_id, status="running")
+    REPORT_JOB_QUEUE_SECONDS.observe(time.time() - job["created"])
+
+    def mark_step(step_id: str, state: str) -> None:
+        job_store.set_step(job_id, step_id, state)
+
+    status = "failed"
+    try:
+        suggestions = optimize_steps(user_inputs, on_step_done=mark_step, draft_id=draft_id)
+        filled = [sid for sid, text in user_inputs.items() if text]
+        failed = [sid for sid in filled if sid not in suggestions]
+        if filled and len(failed) == len(filled):
+            # 所有步骤都失败时报告里只有占位文字，不提供下载
+            job_store.update(job_id, status="failed", error="AI 服务暂不可用，所有步骤的建议都生成失败，请稍后重试",
+                             finished=time.time())
+            REPORT_JOBS.inc(status=status)
+            return
+        data = doc_to_bytes(render_doc(job["topic"], user_inputs, suggestions))
+        job["filename"] = report_filename(job["topic"])
+        # 部分步骤生成失败时记为 partial：报告仍可下载，但不参与去重复用，重新提交会重新生成
+        status = "partial" if failed else "done"
+        job_store.keep_report(job_id, data)
+        if config.REPORT_PERSIST_MODE == "sync":
+            _finish_job_report(job, status, data)
+        elif config.REPORT_PERSIST_MODE == "async":
+            persist_executor.submit(_finish_job_report, job, status, data)
+        else:
+            job_store.update(job_id, status=status, filename=job["filename"], finished=time.time())
+    except Exception as exc:
+        job_store.update(job_id, status="failed", error=f"生成报告时发生错误：{exc}", finished=time.time())
+    REPORT_JOBS.inc(status=status)
+
+
+def _finish_job_report(job: Dict, status: str, data: bytes) -> None:
+    """保存报告后再标记任务完成，其它进程收到完成状态时已能按报告ID下载"""
+    report_id = None
+    try:
+        report_id = report_store.save(job["topic"], job["filename"], job["key"], data)
+    except Exception as exc:
+        print(f"保存报告到输出目录失败: {exc}")
+    job_store.update(job["id"], status=status, filename=job["filename"], report_id=report_id, finished=time.time())
+
+
+def report_job_status(job: Dict) -> Dict[str, object]:
+    steps = job["steps"]
+    status = job["status"]
+    error = job["error"]
+    report_id = job["report_id"]
+    active = [v for v in steps.values() if v != "skipped"]
+    return {
+        "job_id": job["id"],
+        "status": status,
+        "generating": status in ("queued", "running"),
+        "steps": steps,
+        "completed": sum(1 for v in active if v in ("done", "failed", "reused", "similar")),
+        "reused": sum(1 for v in active if v == "reused"),
+        "similar": sum(1 for v in active if v == "similar"),
+        "failed": sum(1 for v in active if v == "failed"),
+        "total": len(active),
+        "error": error,
+        "download_url": url_for("generate_download", task_id=job["id"]) if status in REPORT_READY_STATUSES else None,
+        "report_id": report_id,
+        "report_url": url_for("report_download", report_id=report_id) if report_id else None,
+    }
 
 # -------------------------------------------------------------
 # Web templates
@@ -330,8 +1022,9 @@ def build_doc(topic: str, user_inputs: Dict[str, str], suggestions: Dict[str, st
 @app.route("/")
 @require_access
 def index():
-    step_ids_json = json.dumps([g["id"] for g in GUIDE])
-    return render_template('index.html', guide=GUIDE, step_ids=step_ids_json)
+    guide = current_config().guide
+    step_ids_json = json.dumps([g["id"] for g in guide])
+    return render_template('index.html', guide=guide, step_ids=step_ids_json)
 
 
 @app.route("/access")
@@ -368,7 +1061,22 @@ def admin():
     # 检查是否已登录
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
-    return render_template('admin.html', config=config)
+    return render_template(
+        'admin.html',
+        config=config,
+        cache_stats=llm_cache.stats(),
+        report_stats=report_store.stats(),
+        draft_stats=draft_store.stats(),
+        usage_stats=llm_usage.stats(),
+        llm_status=llm_breaker.status(),
+        scheduler_stats=llm_scheduler.stats(),
+        precheck_stats=step_checker.stats(),
+        similarity_stats=similarity_index.stats(),
+        step_rules_json={
+            step_id: json.dumps(rules, ensure_ascii=False, indent=1)
+            for step_id, rules in config.STEP_RULES.items()
+        },
+    )
 
 
 @app.route("/admin/login")
@@ -422,119 +1130,2782 @@ def admin_save():
 @app.route("/validate", methods=["POST"])
 @require_access
 def validate():
-    data = request.get_json(force=True)
-    step_id = data.get("step_id")
-    inputs = data.get("inputs", {})
-    history = data.get("history", [])  # 新增：历史对话
-    if step_id not in GUIDE_MAP:
-        return jsonify({"error": "参数错误"}), 400
-
-    context = "\n".join([f"{GUIDE_MAP[k]['title']}: {v}" for k, v in inputs.items() if v.strip()])
-    # 拼接当前步骤的A3指导信息
-    st = GUIDE_MAP[step_id]
-    sys_prompt = config.SYSTEM_PROMPTS["step_guidance"].format(
-        title=st['title'],
-        purpose=st['purpose'],
-        tools=st['tools'],
-        focus=st['focus']
-    )
-    user_prompt = config.SYSTEM_PROMPTS["validation"].format(
-        context=context,
-        title=st['title']
+    """AI 检查 / 追问：新检查提交 step_id 和 inputs；追问只需提交 conversation_id 和 question"""
+    try:
+        turn, precheck = start_validation()
+    except ConversationError as exc:
+        return conversation_error_response(exc)
+    if precheck.answer is not None:
+        conversation_id = finish_validation_turn(turn, precheck.answer)
+        return jsonify({"suggestion": precheck.answer, "local": True, "conversation_id": conversation_id})
+    messages = build_validation_messages(turn.step_id, turn.inputs, turn.history, findings=precheck.hints)
+    try:
+        suggestion = call_deepseek_multi(messages, step_id=turn.step_id, owner=turn.owner)
+    except LLMBusyError as exc:
+        return busy_response(exc)
+    except LLMCallError as exc:
+        return llm_error_response(exc)
+    conversation_id = finish_validation_turn(turn, suggestion)
+    return jsonify({"suggestion": suggestion, "conversation_id": conversation_id})
+
+
+def start_validation() -> Tuple["ValidationTurn", "PrecheckResult"]:
+    """解析当前请求的检查 / 追问并做本地预检，同步和异步两种服务方式共用"""
+    turn = begin_validation_turn(request.get_json(force=True), client_id())
+    precheck = step_checker.check(turn.step_id, turn.inputs.get(turn.step_id), followup=turn.followup)
+    return turn, precheck
+
+
+def busy_response(exc: "LLMBusyError"):
+    payload = {"error": str(exc), "queue_position": exc.position, "retry_after": exc.retry_after}
+    return jsonify(payload), 429, {"Retry-After": str(exc.retry_after)}
+
+
+def llm_error_payload(exc: "LLMCallError") -> Dict[str, object]:
+    payload = {"error": str(exc)}
+    if exc.retry_after is not None:
+        payload["retry_after"] = exc.retry_after
+    return payload
+
+
+def llm_error_response(exc: "LLMCallError"):
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after is not None else {}
+    return jsonify(llm_error_payload(exc)), exc.status, headers
+
+
+def conversation_error_response(exc: "ConversationError"):
+    return jsonify({"error": str(exc), "expired": exc.status == 410}), exc.status
+
+
+@app.route("/validate/stream", methods=["POST"])
+@require_access
+def validate_stream():
+    """流式版本的 AI 检查：以 Server-Sent Events 逐段推送模型输出"""
+    try:
+        turn, precheck = start_validation()
+    except ConversationError as exc:
+        return conversation_error_response(exc)
+    if precheck.answer is not None:
+        conversation_id = finish_validation_turn(turn, precheck.answer)
+        return Response(
+            sse_event({"done": True, "suggestion": precheck.answer, "local": True, "conversation_id": conversation_id}),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+    messages = build_validation_messages(turn.step_id, turn.inputs, turn.history, findings=precheck.hints)
+
+    def events():
+        parts = []
+        try:
+            for delta in stream_deepseek_multi(messages, step_id=turn.step_id, owner=turn.owner):
+                if isinstance(delta, LLMQueued):
+                    yield sse_event({"queue_position": delta.position})
+                    continue
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+        except LLMBusyError as exc:
+            yield sse_event({"error": str(exc), "queue_position": exc.position, "retry_after": exc.retry_after})
+            return
+        except LLMCallError as exc:
+            yield sse_event(llm_error_payload(exc))
+            return
+        suggestion = "".join(parts).strip()
+        conversation_id = finish_validation_turn(turn, suggestion)
+        yield sse_event({"done": True, "suggestion": suggestion, "conversation_id": conversation_id})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    messages = [
-        {"role": "system", "content": sys_prompt},
-        {"role": "user", "content": user_prompt}
-    ]
-    for msg in history:
-        if msg.get("role") in ("user","assistant") and msg.get("content"):
-            messages.append({"role": msg["role"], "content": msg["content"]})
-    suggestion = call_deepseek_multi(messages)
-    return jsonify({"suggestion": suggestion})
 
 
 @app.route("/generate", methods=["POST"])
 @require_access
 def generate():
-    # 生成唯一的任务ID
-    import hashlib
-    import time
-    task_data = f"{request.remote_addr}_{time.time()}"
-    task_id = hashlib.md5(task_data.encode()).hexdigest()[:12]
-    
-    # 检查是否已有任务在进行
-    if task_id in generating_reports:
-        return jsonify({"error": "报告生成中，请稍候..."}), 429
-    
-    # 标记任务开始
-    generating_reports.add(task_id)
-    
-    try:
-        user_inputs = {g["id"]: request.form.get(g["id"], "").strip() for g in GUIDE}
-        topic = user_inputs.get("step1", "A3_Topic")[:30]
-
-        suggestions: Dict[str, str] = {}
-        for st in GUIDE:
-            content = user_inputs.get(st["id"], "")
-            if not content:
-                suggestions[st["id"]] = "(用户未填写)"
-                continue
-            prompt = config.SYSTEM_PROMPTS["optimization"].format(
-                title=st['title'],
-                content=content
-            )
-            suggestions[st["id"]] = call_deepseek(prompt, step_id=st["id"])
-
-        path = build_doc(topic, user_inputs, suggestions)
-        
-        # 任务完成，移除标记
-        generating_reports.discard(task_id)
-        
-        return send_file(path, as_attachment=True)
-    
-    except Exception as e:
-        # 发生错误时也要移除标记
-        generating_reports.discard(task_id)
-        flash(f"生成报告时发生错误：{str(e)}")
-        return redirect(url_for('index'))
+    """提交报告生成任务，立即返回任务ID，由前端轮询进度"""
+    user_inputs = {g["id"]: request.form.get(g["id"], "").strip() for g in current_config().guide}
+    job_id, coalesced = submit_report_job(user_inputs, draft_id=client_id())
+    return jsonify({
+        "job_id": job_id,
+        "coalesced": coalesced,
+        "status_url": url_for("generate_status", task_id=job_id),
+        "download_url": url_for("generate_download", task_id=job_id),
+    }), 202
 
 
 @app.route("/generate/status/<task_id>")
 @require_access
 def generate_status(task_id):
-    """检查生成任务状态"""
-    is_generating = task_id in generating_reports
-    return jsonify({"generating": is_generating})
+    """检查生成任务状态及各步骤进度"""
+    job = job_store.get(task_id)
+    if job is None:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    return jsonify(report_job_status(job))
+
+
+@app.route("/generate/download/<task_id>")
+@require_access
+def generate_download(task_id):
+    """下载已完成任务生成的 Word 文档"""
+    job = job_store.get(task_id)
+    if job is None:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    if job["status"] not in REPORT_READY_STATUSES:
+        return jsonify({"error": "报告尚未生成完成", "status": job["status"]}), 409
+    data = job_store.report(job)
+    if data is None:
+        return jsonify({"error": "报告文件已被清理，请重新生成"}), 404
+    return docx_response(data, job["filename"])
+
+@app.route("/reports/<report_id>")
+@require_access
+def report_download(report_id):
+    """按报告ID重新下载历史报告，无需重新生成"""
+    found = report_store.read(report_id)
+    if found is None:
+        return jsonify({"error": "报告不存在或已被清理"}), 404
+    meta, data = found
+    return docx_response(data, meta["filename"])
+
+@app.route("/batch", methods=["POST"])
+@require_access
+def batch_generate():
+    """批量生成：上传 JSONL / CSV，边生成边以 ZIP 流式返回，附带每份报告的结果清单"""
+    upload = request.files.get("file")
+    if upload is None or not upload.filename:
+        return jsonify({"error": "请上传 JSONL 或 CSV 文件"}), 400
+    try:
+        records = parse_batch_file(upload.filename, upload.read())
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    filename = f"A3_batch_{_dt.datetime.now():%Y%m%d_%H%M}.zip"
+    return Response(
+        stream_with_context(iter_batch_zip(records, owner=client_id())),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=\"{filename}\""},
+    )
+
+# -------------------------------------------------------------
+# 本地预检：AI 检查前按 STEP_RULES 做规则检查
+
+STEP_CHECKS = {}
+
+
+def step_check(rule_name: str):
+    """注册一种规则的检查函数：func(text, value) -> [(是否直接答复, 说明)]"""
+    def register(func):
+        STEP_CHECKS[rule_name] = func
+        return func
+    return register
+
+
+@step_check("min_length")
+def _check_min_length(text: str, value) -> List[Tuple[bool, str]]:
+    length = len("".join(text.split()))
+    if length < int(value):
+        return [(True, f"内容过短（{length} 字），请至少写 {int(value)} 字，说明清楚本步骤的要点")]
+    return []
+
+
+@step_check("require")
+def _check_require(text: str, value) -> List[Tuple[bool, str]]:
+    return [(True, f"缺少{name}") for name, pattern in value if not pattern.search(text)]
+
+
+@step_check("recommend")
+def _check_recommend(text: str, value) -> List[Tuple[bool, str]]:
+    return [(False, f"未提及{name}") for name, pattern in value if not pattern.search(text)]
+
+
+@dataclass(frozen=True)
+class PrecheckResult:
+    """answer 不为 None 时直接作为检查结果返回；hints 为附加到提示词中的提示"""
+    answer: Optional[str]
+    hints: Tuple[str, ...]
+
+
+class StepChecker:
+    """按配置快照中的规则检查单个步骤，统计直接答复（省下的 AI 调用）与附加提示的次数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"checked": 0, "answered": 0, "hinted": 0}
+        self._seconds = 0.0
+
+    def check(self, step_id: str, text: Optional[str], followup: bool = False) -> PrecheckResult:
+        """followup 为 True（追问）时不直接答复，只附加提示"""
+        started = time.perf_counter()
+        cfg = current_config()
+        text = text if isinstance(text, str) else ""
+        if not text.strip():
+            findings = [(True, "本步骤尚未填写")]
+        else:
+            findings = []
+            for rule_name, value in cfg.step_rules.get(step_id, {}).items():
+                check = STEP_CHECKS.get(rule_name)
+                if check is not None:
+                    findings.extend(check(text, value))
+        blocking = [message for block, message in findings if block]
+        if blocking and not followup:
+            result = PrecheckResult(precheck_answer(cfg.guide_map[step_id], blocking), ())
+        else:
+            result = PrecheckResult(None, tuple(message for _, message in findings))
+        outcome = "answered" if result.answer is not None else "hinted" if result.hints else "passed"
+        with self._lock:
+            self.counters["checked"] += 1
+            if outcome != "passed":
+                self.counters[outcome] += 1
+            self._seconds += time.perf_counter() - started
+        PRECHECK_RESULTS.inc(result=outcome)
+        return result
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            stats = dict(self.counters)
+            seconds = self._seconds
+        stats["avg_us"] = f"{seconds / stats['checked'] * 1e6:.0f}" if stats["checked"] else "-"
+        return stats
+
+
+def precheck_answer(step: Mapping[str, str], problems: List[str]) -> str:
+    lines = [f"【本地检查】《{step['title']}》还不完整，请先补充以下内容后再请 AI 检查："]
+    lines += [f"- {problem}" for problem in problems]
+    lines.append(f"本步骤目的：{step['purpose']}；要点：{step['focus']}")
+    return "\n".join(lines)
+
+
+step_checker = StepChecker()
 
 # -------------------------------------------------------------
 # 新增多轮对话支持
 
-def call_deepseek_multi(messages, api_key: str = None) -> str:
-    api_key = api_key or DEEPSEEK_API_KEY
-    client = openai.OpenAI(api_key=api_key, base_url=config.DEEPSEEK_BASE_URL)
+def call_deepseek_multi(messages, api_key: str = None, step_id: str = None,
+                        priority: int = None, owner: str = None, response_format: Dict = None) -> str:
+    """返回模型回复；重试用尽、超时或熔断时抛出 LLMCallError，排队已满或等待超时抛出 LLMBusyError
+
+    priority 默认为交互式检查（最高优先级），owner 为同一优先级内轮流放行的用户标识。
+    response_format 原样传给接口，例如 {"type": "json_object"}。
+    """
+    extra = {"response_format": response_format} if response_format else {}
+    model = current_config().model_name
+    cached = llm_cache.get(messages)
+    if cached is not None:
+        LLM_CACHE_HITS.inc(step=step_id or "-", model=model)
+        return cached
+    client = llm_clients.get(api_key)
+    with llm_scheduler.slot(priority, owner, messages_tokens(messages)) as ticket:
+        LLM_IN_FLIGHT.inc(model=model)
+        started = time.perf_counter()
+        try:
+            resp = llm_request(lambda timeout: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=False,
+                timeout=timeout,
+                **extra,
+            ))
+        except LLMCallError:
+            LLM_ERRORS.inc(step=step_id or "-", model=model)
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec(model=model)
+            LLM_SECONDS.observe(time.perf_counter() - started, step=step_id or "-", model=model, mode="sync")
+        ticket.used_tokens = getattr(resp.usage, "total_tokens", None)
+    llm_usage.record(resp.usage, model)
+    content = (resp.choices[0].message.content or "").strip()
+    llm_cache.put(messages, content)
+    return content
+
+
+def stream_deepseek_multi(messages, api_key: str = None, step_id: str = None,
+                          priority: int = None, owner: str = None):
+    """逐段产出模型回复；命中缓存时一次性返回完整内容，结束后写入缓存
+
+    排队等待期间每秒产出一个 LLMQueued（当前排队位置），其余产出均为文本片段。
+    只在收到第一段输出之前重试；输出中途断开时抛出 LLMCallError。
+    """
+    model = current_config().model_name
+    cached = llm_cache.get(messages)
+    if cached is not None:
+        LLM_CACHE_HITS.inc(step=step_id or "-", model=model)
+        yield cached
+        return
+    client = llm_clients.get(api_key)
+    ticket = llm_scheduler.submit(priority, owner, messages_tokens(messages))
+    try:
+        while not llm_scheduler.wait(ticket, 1.0):
+            llm_scheduler.check_timeout(ticket)
+            yield LLMQueued(llm_scheduler.position(ticket))
+        yield from _stream_granted(client, model, messages, step_id, ticket)
+    finally:
+        llm_scheduler.release(ticket)
+
+
+def _stream_granted(client, model: str, messages, step_id: str, ticket: "_Ticket"):
+    LLM_IN_FLIGHT.inc(model=model)
+    started = time.perf_counter()
+    parts = []
     try:
-        resp = client.chat.completions.create(
-            model=config.MODEL_NAME,
+        stream = llm_request(lambda timeout: client.chat.completions.create(
+            model=model,
             messages=messages,
-            stream=False,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=timeout,
+        ), hedge=False)
+        try:
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    llm_usage.record(chunk.usage, model)
+                    ticket.used_tokens = getattr(chunk.usage, "total_tokens", None)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        except Exception as exc:
+            LLM_OUTCOMES.inc(outcome="stream_broken")
+            raise LLMCallError(describe_llm_error(exc), 502) from exc
+        finally:
+            stream.close()
+    except LLMCallError:
+        LLM_ERRORS.inc(step=step_id or "-", model=model)
+        raise
+    finally:
+        LLM_IN_FLIGHT.dec(model=model)
+        LLM_SECONDS.observe(time.perf_counter() - started, step=step_id or "-", model=model, mode="stream")
+    llm_cache.put(messages, "".join(parts).strip())
+
+
+async def call_deepseek_multi_async(messages, api_key: str = None, step_id: str = None,
+                                    priority: int = None, owner: str = None) -> str:
+    """call_deepseek_multi 的协程版本，供异步服务使用；排队和等待上游期间不占用线程
+
+    缓存读写可能访问 SQLite（写锁最长等待 10 秒），放到线程中执行，不阻塞事件循环。
+    """
+    model = current_config().model_name
+    cached = await asyncio.to_thread(llm_cache.get, messages)
+    if cached is not None:
+        LLM_CACHE_HITS.inc(step=step_id or "-", model=model)
+        return cached
+    client = async_llm_clients.get(api_key)
+    async with llm_scheduler.slot_async(priority, owner, messages_tokens(messages)) as ticket:
+        LLM_IN_FLIGHT.inc(model=model)
+        started = time.perf_counter()
+        try:
+            resp = await llm_request_async(lambda timeout: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=False,
+                timeout=timeout,
+            ))
+        except LLMCallError:
+            LLM_ERRORS.inc(step=step_id or "-", model=model)
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec(model=model)
+            LLM_SECONDS.observe(time.perf_counter() - started, step=step_id or "-", model=model, mode="async")
+        ticket.used_tokens = getattr(resp.usage, "total_tokens", None)
+    llm_usage.record(resp.usage, model)
+    content = (resp.choices[0].message.content or "").strip()
+    await asyncio.to_thread(llm_cache.put, messages, content)
+    return content
+
+
+async def stream_deepseek_multi_async(messages, api_key: str = None, step_id: str = None,
+                                      priority: int = None, owner: str = None):
+    """stream_deepseek_multi 的异步生成器版本，产出内容相同"""
+    model = current_config().model_name
+    cached = await asyncio.to_thread(llm_cache.get, messages)
+    if cached is not None:
+        LLM_CACHE_HITS.inc(step=step_id or "-", model=model)
+        yield cached
+        return
+    client = async_llm_clients.get(api_key)
+    ticket = llm_scheduler.submit(priority, owner, messages_tokens(messages))
+    try:
+        while not await llm_scheduler.wait_async(ticket, 1.0):
+            llm_scheduler.check_timeout(ticket)
+            yield LLMQueued(llm_scheduler.position(ticket))
+        LLM_IN_FLIGHT.inc(model=model)
+        started = time.perf_counter()
+        parts = []
+        try:
+            stream = await llm_request_async(lambda timeout: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=timeout,
+            ), hedge=False)
+            try:
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None) is not None:
+                        llm_usage.record(chunk.usage, model)
+                        ticket.used_tokens = getattr(chunk.usage, "total_tokens", None)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+            except Exception as exc:
+                LLM_OUTCOMES.inc(outcome="stream_broken")
+                raise LLMCallError(describe_llm_error(exc), 502) from exc
+            finally:
+                await stream.close()
+        except LLMCallError:
+            LLM_ERRORS.inc(step=step_id or "-", model=model)
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec(model=model)
+            LLM_SECONDS.observe(time.perf_counter() - started, step=step_id or "-", model=model, mode="stream")
+    finally:
+        llm_scheduler.release(ticket)
+    await asyncio.to_thread(llm_cache.put, messages, "".join(parts).strip())
+
+
+def sse_event(payload: Dict[str, object]) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+# -------------------------------------------------------------
+# LLM 客户端连接池
+
+class LLMClientManager:
+    """进程级 LLM 客户端：复用 keep-alive 连接池，仅在 Key / Base URL / 模型变化时重建
+
+    asynchronous=True 时创建 openai.AsyncOpenAI，供异步服务（ASGI）的事件循环使用。
+    """
+
+    def __init__(self, asynchronous: bool = False):
+        self.asynchronous = asynchronous
+        self._lock = threading.Lock()
+        # (签名, 客户端) 作为整体替换，读取时无需加锁
+        self._current = (None, None)
+
+    def get(self, api_key: str = None):
+        cfg = current_config()
+        signature = (api_key or cfg.api_key, cfg.base_url, cfg.model_name)
+        current_signature, client = self._current
+        if client is not None and current_signature == signature:
+            return client
+        with self._lock:
+            current_signature, client = self._current
+            if client is None or current_signature != signature:
+                old = client
+                client = self._build(signature[0], signature[1])
+                self._current = (signature, client)
+                if old is not None:
+                    self._retire(old)
+            return client
+
+    def _retire(self, client) -> None:
+        """被替换的客户端在进行中的请求结束后（LLM_DEADLINE 之后）关闭，释放其连接池"""
+        delay = config.LLM_DEADLINE + 5
+        if not self.asynchronous:
+            timer = threading.Timer(delay, client.close)
+            timer.daemon = True
+            timer.start()
+            return
+        # 异步客户端的连接属于创建它们的事件循环，需在同一循环中关闭；get() 总是在该循环中调用
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        loop.call_later(delay, lambda: loop.create_task(client.close()))
+
+    def _build(self, api_key: str, base_url: str):
+        import httpx
+        import openai
+
+        limits = httpx.Limits(
+            max_connections=config.LLM_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=config.LLM_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=config.LLM_POOL_KEEPALIVE_EXPIRY,
         )
-        return resp.choices[0].message.content.strip()
-    except Exception as exc:
-        return f"<LLM 调用失败> {exc}"
+        if self.asynchronous:
+            http_client = openai.DefaultAsyncHttpxClient(limits=limits, http2=http2_available())
+            client_class = openai.AsyncOpenAI
+        else:
+            http_client = openai.DefaultHttpxClient(limits=limits, http2=http2_available())
+            client_class = openai.OpenAI
+        # 重试和超时由 llm_request 统一控制，SDK 自身不再重试
+        return client_class(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=0,
+            timeout=config.LLM_TIMEOUT,
+        )
+
+
+def http2_available() -> bool:
+    """已开启 LLM_HTTP2 且安装了 h2 时才使用 HTTP/2"""
+    if not config.LLM_HTTP2:
+        return False
+    import importlib.util
+    return importlib.util.find_spec("h2") is not None
+
 
-def set_font_simsun(run):
-    run.font.name = config.DOC_FONT_NAME
-    run._element.rPr.rFonts.set(qn('w:eastAsia'), config.DOC_FONT_NAME)
+llm_clients = LLMClientManager()
+async_llm_clients = LLMClientManager(asynchronous=True)
 
 # -------------------------------------------------------------
-if __name__ == "__main__":
-    ensure_api_key()
-    # 从配置读取主机和端口
-    host = config.HOST
-    port = config.PORT
-    webbrowser.open(f"http://localhost:{port}")
-    if getattr(sys, "frozen", False):
-        from waitress import serve
-        serve(app, host=host, port=port)
+# LLM 调用容错
+
+class LLMCallError(Exception):
+    """LLM 调用最终失败（重试用尽、超时或熔断）；消息可直接展示给用户，status 为对应的 HTTP 状态码
+
+    上游限流（429）或熔断中时 retry_after 为建议的重试间隔（秒），由路由原样放入 Retry-After。
+    """
+
+    def __init__(self, message: str, status: int = 502, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断：冷却期内直接失败，冷却结束后只放行一个探测请求"""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    def before_call(self) -> bool:
+        """熔断中直接抛出 LLMCallError；返回 True 表示本次调用是半开状态下的探测请求"""
+        if self.threshold <= 0:
+            return False
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if remaining <= 0 and not self._probing:
+                self._probing = True
+                return True
+        LLM_OUTCOMES.inc(outcome="circuit_open")
+        retry_after = max(1, int(remaining) + 1)
+        raise LLMCallError(f"AI 服务暂时不可用，已暂停调用，请约 {retry_after} 秒后重试", 503, retry_after)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+        LLM_CIRCUIT_OPEN.set(0)
+
+    def end_probe(self) -> None:
+        """探测请求结束；以 4xx 或取消结束时既不算成功也不算失败，下一次调用重新探测"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.threshold <= 0 or self.failures < self.threshold:
+                return
+            if self._opened_at is None:
+                print(f"AI 服务连续 {self.failures} 次调用失败，暂停调用 {self.cooldown:g} 秒")
+            self._opened_at = time.monotonic()
+        LLM_CIRCUIT_OPEN.set(1)
+
+    def status(self) -> Dict[str, object]:
+        with self._lock:
+            if self._opened_at is None:
+                return {"state": "closed", "failures": self.failures, "retry_in": 0}
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+        return {
+            "state": "open" if remaining > 0 else "half_open",
+            "failures": self.failures,
+            "retry_in": max(0, int(remaining) + 1),
+        }
+
+
+class LatencyWindow:
+    """最近若干次成功调用的耗时，用于估算对冲请求的触发时间"""
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def is_retryable(exc: Exception) -> bool:
+    import openai
+
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    return False
+
+
+def is_upstream_failure(exc: Exception) -> bool:
+    """超时、连接失败和 5xx 计入熔断；429 和其它 4xx 属于请求本身的问题，不计入"""
+    import openai
+
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+def describe_llm_error(exc: Exception) -> str:
+    import openai
+
+    if isinstance(exc, openai.APITimeoutError):
+        return "AI 服务响应超时，请稍后重试"
+    if isinstance(exc, openai.APIConnectionError):
+        return "无法连接 AI 服务，请检查网络或接口地址"
+    if isinstance(exc, openai.APIStatusError):
+        if exc.status_code == 401:
+            return "AI 服务认证失败，请检查 API Key"
+        if exc.status_code == 429:
+            return "AI 服务请求过于频繁，请稍后重试"
+        if exc.status_code >= 500:
+            return f"AI 服务暂时不可用（HTTP {exc.status_code}），请稍后重试"
+        return f"AI 服务返回错误（HTTP {exc.status_code}）"
+    return f"AI 调用失败：{exc}"
+
+
+def retry_delay(attempt: int, exc: Exception) -> float:
+    """指数退避加全抖动；429 带 Retry-After 时按服务端要求等待"""
+    response = getattr(exc, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), config.LLM_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(config.LLM_RETRY_MAX_DELAY, config.LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def upstream_retry_after(exc: Exception) -> int:
+    """上游 429 响应的 Retry-After（秒），没有时按最大退避间隔估计"""
+    response = getattr(exc, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return max(1, math.ceil(float(value)))
+    except (TypeError, ValueError, OverflowError):
+        return max(1, int(config.LLM_RETRY_MAX_DELAY))
+
+
+def llm_request(create, hedge: bool = True):
+    """带截止时间、重试、对冲和熔断的单次 LLM 请求
+
+    create(timeout) 发起一次请求并返回结果；每次尝试的超时不超过剩余的总时限。
+    """
+    deadline = time.monotonic() + config.LLM_DEADLINE
+    attempt = 0
+    while True:
+        timeout, probe = _attempt_timeout(deadline)
+        started = time.monotonic()
+        try:
+            if hedge and config.LLM_HEDGE_ENABLED:
+                result = _hedged_call(create, timeout)
+            else:
+                result = create(timeout)
+        except Exception as exc:
+            attempt += 1
+            delay = _retry_or_raise(exc, attempt, deadline)
+        else:
+            _record_llm_success(started, attempt)
+            return result
+        finally:
+            if probe:
+                llm_breaker.end_probe()
+        time.sleep(delay)
+
+
+async def llm_request_async(create, hedge: bool = True):
+    """llm_request 的协程版本：create(timeout) 返回可等待对象，等待期间不占用线程"""
+    deadline = time.monotonic() + config.LLM_DEADLINE
+    attempt = 0
+    while True:
+        timeout, probe = _attempt_timeout(deadline)
+        started = time.monotonic()
+        try:
+            if hedge and config.LLM_HEDGE_ENABLED:
+                result = await _hedged_call_async(create, timeout)
+            else:
+                result = await create(timeout)
+        except Exception as exc:
+            attempt += 1
+            delay = _retry_or_raise(exc, attempt, deadline)
+        else:
+            _record_llm_success(started, attempt)
+            return result
+        finally:
+            # 客户端断开时 CancelledError 不经过 except，也要在这里结束探测
+            if probe:
+                llm_breaker.end_probe()
+        await asyncio.sleep(delay)
+
+
+def _attempt_timeout(deadline: float) -> Tuple[float, bool]:
+    """返回本次尝试可用的超时，以及是否为熔断器的探测请求（调用方须在结束后 end_probe）"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        LLM_OUTCOMES.inc(outcome="deadline")
+        raise LLMCallError("AI 服务响应超时，请稍后重试", 504)
+    probe = llm_breaker.before_call()
+    return min(config.LLM_TIMEOUT, remaining), probe
+
+
+def _retry_or_raise(exc: Exception, attempt: int, deadline: float) -> float:
+    """记录第 attempt 次尝试的失败；还可以重试时返回等待秒数，否则抛出 LLMCallError"""
+    if is_upstream_failure(exc):
+        llm_breaker.record_failure()
+    delay = retry_delay(attempt - 1, exc)
+    if (
+        not is_retryable(exc)
+        or attempt > config.LLM_MAX_RETRIES
+        or time.monotonic() + delay >= deadline
+    ):
+        LLM_OUTCOMES.inc(outcome="failure")
+        print(f"LLM 调用失败（第 {attempt} 次尝试）: {exc!r}")
+        import openai
+        if isinstance(exc, openai.APIStatusError) and exc.status_code == 429:
+            # 上游限流原样返回 429，让客户端按 Retry-After 稍后重试
+            raise LLMCallError(describe_llm_error(exc), 429, upstream_retry_after(exc)) from exc
+        status = 504 if isinstance(exc, openai.APITimeoutError) else 502
+        raise LLMCallError(describe_llm_error(exc), status) from exc
+    LLM_OUTCOMES.inc(outcome="retry")
+    return delay
+
+
+def _record_llm_success(started: float, attempt: int) -> None:
+    llm_breaker.record_success()
+    llm_latency.add(time.monotonic() - started)
+    LLM_OUTCOMES.inc(outcome="success" if attempt == 0 else "success_after_retry")
+
+
+def _hedged_call(create, timeout: float):
+    """首个请求超过近期 p95 耗时仍未返回时，再发一个相同请求，取先成功的结果"""
+    p95 = llm_latency.percentile(95)
+    delay = max(config.LLM_HEDGE_MIN_DELAY, p95 or 0.0)
+    if delay >= timeout:
+        return create(timeout)
+    first = hedge_executor.submit(create, timeout)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+    LLM_OUTCOMES.inc(outcome="hedge")
+    second = hedge_executor.submit(create, timeout - delay)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    LLM_OUTCOMES.inc(outcome="hedge_won")
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+async def _hedged_call_async(create, timeout: float):
+    """_hedged_call 的协程版本；先成功的结果返回后，落后的请求直接取消"""
+    p95 = llm_latency.percentile(95)
+    delay = max(config.LLM_HEDGE_MIN_DELAY, p95 or 0.0)
+    if delay >= timeout:
+        return await create(timeout)
+    first = asyncio.ensure_future(create(timeout))
+    pending = {first}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return first.result()
+        LLM_OUTCOMES.inc(outcome="hedge")
+        second = asyncio.ensure_future(create(timeout - delay))
+        pending.add(second)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        LLM_OUTCOMES.inc(outcome="hedge_won")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+llm_breaker = CircuitBreaker(config.LLM_BREAKER_THRESHOLD, config.LLM_BREAKER_COOLDOWN)
+llm_latency = LatencyWindow()
+# 对冲请求在独立线程中执行，落后的一方自然结束，不影响调用方
+hedge_executor = ThreadPoolExecutor(
+    max_workers=max(2, config.LLM_MAX_CONCURRENCY * 2),
+    thread_name_prefix="a3-hedge",
+)
+
+# -------------------------------------------------------------
+# LLM 调度：全局并发与 token 额度、优先级队列、按用户轮转
+
+PRIORITY_INTERACTIVE = 0  # AI 检查 / 追问
+PRIORITY_GENERATE = 1  # 生成报告
+PRIORITY_BATCH = 2  # 批量生成
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "validate", PRIORITY_GENERATE: "generate", PRIORITY_BATCH: "batch"}
+
+
+class LLMBusyError(LLMCallError):
+    """调度队列已满或排队超时；position 为当时的排队位置，retry_after 为建议的重试间隔（秒）"""
+
+    def __init__(self, position: int, retry_after: int):
+        super().__init__(f"AI 服务繁忙，当前排在第 {position} 位，请约 {retry_after} 秒后重试", 429, retry_after)
+        self.position = position
+
+
+@dataclass(frozen=True)
+class LLMQueued:
+    """流式调用排队期间产出的状态"""
+    position: int
+
+
+class _Ticket:
+    __slots__ = ("priority", "owner", "tokens", "seq", "enqueued", "granted", "entry", "used_tokens", "waker")
+
+    def __init__(self, priority: int, owner: str, tokens: int, seq: int):
+        self.priority = priority
+        self.owner = owner
+        self.tokens = tokens
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.entry = None
+        self.used_tokens = None
+        self.waker = None  # 协程等待放行时，由 _dispatch 在放行后调用
+
+
+class LLMScheduler:
+    """所有上游 LLM 调用的统一入口
+
+    - 同时进行的调用不超过 max_concurrency，其中 reserved 个名额只留给交互式检查；
+    - 最近 60 秒内的 token 数（提交时按提示词估算，完成后按实际用量修正）不超过 tokens_per_minute；
+    - 优先级高的先放行，同一优先级内按用户轮流放行，避免一份大报告占满队列；
+    - 交互式调用排队数超过 max_queue 或等待超过 queue_timeout 秒时直接拒绝，由调用方返回 429。
+    限额按进程计算，多进程部署时按进程数分摊。
+    """
+
+    WINDOW = 60.0
+    COMPLETION_TOKENS = 512  # 提交时对输出 token 数的估计
+
+    def __init__(self, max_concurrency: int, reserved: int, tokens_per_minute: int,
+                 max_queue: int, queue_timeout: float):
+        self.max_concurrency = max(1, max_concurrency)
+        self.reserved = min(max(0, reserved), self.max_concurrency - 1)
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        # 每个优先级一个按用户分组的队列，OrderedDict 的顺序即轮转顺序
+        self._queues: Dict[int, "OrderedDict[str, deque]"] = {p: OrderedDict() for p in PRIORITY_NAMES}
+        self._running = 0
+        self._window = deque()
+        self._seq = 0
+
+    def submit(self, priority: int = None, owner: str = None, prompt_tokens: int = 0) -> _Ticket:
+        priority = PRIORITY_INTERACTIVE if priority is None else priority
+        with self._cond:
+            if priority == PRIORITY_INTERACTIVE and 0 < self.max_queue <= self._waiting(priority):
+                position = self._waiting(priority) + 1
+                LLM_QUEUE_REJECTED.inc(priority=PRIORITY_NAMES[priority])
+                raise LLMBusyError(position, self._retry_after(position))
+            self._seq += 1
+            ticket = _Ticket(priority, owner or "-", prompt_tokens + self.COMPLETION_TOKENS, self._seq)
+            self._queues[priority].setdefault(ticket.owner, deque()).append(ticket)
+            self._dispatch()
+        return ticket
+
+    def wait(self, ticket: _Ticket, timeout: Optional[float] = None) -> bool:
+        """等待放行，超时返回 False（仍在队列中）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not ticket.granted:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                # token 额度随时间恢复，没有其它调用结束时也要定期重新检查
+                self._cond.wait(1.0 if remaining is None else min(remaining, 1.0))
+                self._dispatch()
+        return True
+
+    async def wait_async(self, ticket: _Ticket, timeout: Optional[float] = None) -> bool:
+        """wait 的协程版本：在事件循环中等待放行，不占用线程"""
+        loop = asyncio.get_running_loop()
+        granted = asyncio.Event()
+        with self._cond:
+            self._dispatch()
+            if ticket.granted:
+                return True
+            ticket.waker = lambda: loop.call_soon_threadsafe(granted.set)
+        try:
+            await asyncio.wait_for(granted.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                ticket.waker = None
+        return ticket.granted
+
+    def check_timeout(self, ticket: _Ticket) -> None:
+        """交互式调用排队超过 queue_timeout 时抛出 LLMBusyError"""
+        if ticket.priority != PRIORITY_INTERACTIVE or self.queue_timeout <= 0:
+            return
+        if time.monotonic() - ticket.enqueued < self.queue_timeout:
+            return
+        position = self.position(ticket)
+        LLM_QUEUE_REJECTED.inc(priority=PRIORITY_NAMES[ticket.priority])
+        raise LLMBusyError(position, self._retry_after(position))
+
+    def release(self, ticket: _Ticket) -> None:
+        """调用结束时归还名额；尚未放行的则移出队列"""
+        with self._cond:
+            if ticket.granted:
+                self._running -= 1
+                if ticket.used_tokens is not None:
+                    ticket.entry[1] = ticket.used_tokens
+            else:
+                queue = self._queues[ticket.priority]
+                tickets = queue.get(ticket.owner)
+                if tickets is not None and ticket in tickets:
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del queue[ticket.owner]
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, priority: int = None, owner: str = None, prompt_tokens: int = 0):
+        ticket = self.submit(priority, owner, prompt_tokens)
+        try:
+            while not self.wait(ticket, 1.0):
+                self.check_timeout(ticket)
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def slot_async(self, priority: int = None, owner: str = None, prompt_tokens: int = 0):
+        ticket = self.submit(priority, owner, prompt_tokens)
+        try:
+            while not await self.wait_async(ticket, 1.0):
+                self.check_timeout(ticket)
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def position(self, ticket: _Ticket) -> int:
+        """排队位置（从 1 开始）：更高优先级的等待数加同优先级中更早提交的等待数"""
+        with self._cond:
+            if ticket.granted:
+                return 0
+            ahead = 0
+            for priority, queue in self._queues.items():
+                for tickets in queue.values():
+                    if priority < ticket.priority:
+                        ahead += len(tickets)
+                    elif priority == ticket.priority:
+                        ahead += sum(1 for t in tickets if t.seq < ticket.seq)
+            return ahead + 1
+
+    def stats(self) -> Dict[str, object]:
+        with self._cond:
+            self._expire(time.monotonic())
+            return {
+                "running": self._running,
+                "max_concurrency": self.max_concurrency,
+                "waiting": {PRIORITY_NAMES[p]: self._waiting(p) for p in PRIORITY_NAMES},
+                "tokens_last_minute": sum(entry[1] for entry in self._window),
+                "tokens_per_minute": self.tokens_per_minute,
+            }
+
+    def _waiting(self, priority: int) -> int:
+        return sum(len(tickets) for tickets in self._queues[priority].values())
+
+    def _retry_after(self, position: int) -> int:
+        typical = llm_latency.percentile(50) or 5.0
+        return max(1, int(position * typical / self.max_concurrency) + 1)
+
+    def _expire(self, now: float) -> None:
+        while self._window and self._window[0][0] <= now - self.WINDOW:
+            self._window.popleft()
+
+    def _dispatch(self) -> None:
+        """在持有锁时调用：按优先级和轮转顺序放行，直到名额或 token 额度用完"""
+        now = time.monotonic()
+        self._expire(now)
+        granted = False
+        for priority, queue in self._queues.items():
+            limit = self.max_concurrency if priority == PRIORITY_INTERACTIVE else self.max_concurrency - self.reserved
+            while queue and self._running < limit:
+                owner, tickets = next(iter(queue.items()))
+                ticket = tickets[0]
+                used = sum(entry[1] for entry in self._window)
+                # 单个调用超过整分钟额度时，等窗口清空后单独放行
+                if self.tokens_per_minute > 0 and used + ticket.tokens > self.tokens_per_minute and self._window:
+                    break
+                tickets.popleft()
+                if tickets:
+                    queue.move_to_end(owner)
+                else:
+                    del queue[owner]
+                ticket.granted = True
+                ticket.entry = [now, ticket.tokens]
+                self._window.append(ticket.entry)
+                self._running += 1
+                granted = True
+                if ticket.waker is not None:
+                    ticket.waker()
+                LLM_QUEUE_SECONDS.observe(now - ticket.enqueued, priority=PRIORITY_NAMES[priority])
+            if queue:
+                # 高优先级仍在等待时，低优先级不能越过它占用名额或额度
+                break
+        for priority in PRIORITY_NAMES:
+            LLM_QUEUE_DEPTH.set(self._waiting(priority), priority=PRIORITY_NAMES[priority])
+        if granted:
+            self._cond.notify_all()
+
+
+llm_scheduler = LLMScheduler(
+    config.LLM_GLOBAL_CONCURRENCY,
+    config.LLM_INTERACTIVE_RESERVED,
+    config.LLM_TOKENS_PER_MINUTE,
+    config.LLM_QUEUE_MAX,
+    config.LLM_QUEUE_TIMEOUT,
+)
+
+# -------------------------------------------------------------
+# LLM 用量统计
+
+class LLMUsageStats:
+    """汇总每次调用返回的 usage，重点关注 DeepSeek 前缀缓存的命中 token 数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cache_hit_tokens": 0,
+            "cache_miss_tokens": 0,
+        }
+
+    def record(self, usage, model: str = None) -> None:
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        hit = getattr(usage, "prompt_cache_hit_tokens", None)
+        miss = getattr(usage, "prompt_cache_miss_tokens", None)
+        if hit is None:
+            # 兼容 OpenAI 格式：prompt_tokens_details.cached_tokens
+            details = getattr(usage, "prompt_tokens_details", None)
+            hit = getattr(details, "cached_tokens", 0) or 0
+        if miss is None:
+            miss = max(prompt_tokens - hit, 0)
+        with self._lock:
+            self.counters["calls"] += 1
+            self.counters["prompt_tokens"] += prompt_tokens
+            self.counters["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+            self.counters["cache_hit_tokens"] += hit
+            self.counters["cache_miss_tokens"] += miss
+        model = model or current_config().model_name
+        LLM_TOKENS.inc(prompt_tokens, model=model, type="prompt")
+        LLM_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, model=model, type="completion")
+        LLM_TOKENS.inc(hit, model=model, type="cache_hit")
+        LLM_TOKENS.inc(miss, model=model, type="cache_miss")
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            stats = dict(self.counters)
+        total = stats["cache_hit_tokens"] + stats["cache_miss_tokens"]
+        stats["hit_rate"] = f"{stats['cache_hit_tokens'] / total:.1%}" if total else "-"
+        return stats
+
+
+llm_usage = LLMUsageStats()
+
+# -------------------------------------------------------------
+# 运行指标（Prometheus 文本格式）
+
+class Metric:
+    """极简指标：按标签值元组保存数值，每个指标一把锁，记录开销仅为一次字典更新"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{self._format_labels(key)} {value}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for idx, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    entry[0][idx] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return _HistogramTimer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(entry[0]), entry[1], entry[2])) for key, entry in self._values.items()]
+        for key, (buckets, total, count) in items:
+            cumulative = 0
+            for bound, hits in zip(self.BUCKETS, buckets):
+                cumulative += hits
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else bound)
+                yield f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}"
+            yield f"{self.name}_sum{self._format_labels(key)} {total}"
+            yield f"{self.name}_count{self._format_labels(key)} {count}"
+
+
+class _HistogramTimer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
+
+
+metrics_registry: List[Metric] = []
+
+HTTP_SECONDS = Histogram("a3_http_request_duration_seconds", "HTTP 请求耗时（流式响应计到推送结束）", ("endpoint", "method", "status"))
+HTTP_IN_FLIGHT = Gauge("a3_http_requests_in_flight", "正在处理的 HTTP 请求数")
+LLM_SECONDS = Histogram("a3_llm_request_duration_seconds", "LLM 调用耗时", ("step", "model", "mode"))
+LLM_IN_FLIGHT = Gauge("a3_llm_requests_in_flight", "正在进行的 LLM 调用数", ("model",))
+LLM_ERRORS = Counter("a3_llm_errors_total", "LLM 调用失败次数", ("step", "model"))
+LLM_OUTCOMES = Counter("a3_llm_outcomes_total", "LLM 请求各类结果（成功、重试、对冲、熔断、超时等）的次数", ("outcome",))
+LLM_QUEUE_SECONDS = Histogram("a3_llm_queue_seconds", "LLM 调用在调度队列中的等待时间（秒）", ("priority",))
+LLM_QUEUE_DEPTH = Gauge("a3_llm_queue_depth", "调度队列中等待的 LLM 调用数", ("priority",))
+LLM_QUEUE_REJECTED = Counter("a3_llm_queue_rejected_total", "因排队已满或等待超时被拒绝的 LLM 调用次数", ("priority",))
+PRECHECK_RESULTS = Counter("a3_precheck_total", "本地预检结果（answered 直接答复未调用 AI / hinted 附加提示 / passed 通过）", ("result",))
+SIMILAR_LOOKUPS = Counter("a3_similar_lookups_total", "相似步骤索引查询结果（hit 复用 / miss 未命中）", ("result",))
+STRUCTURED_STEPS = Counter("a3_structured_steps_total", "结构化一次生成中各步骤的结果（ok 直接采用 / fallback 改为单独调用）", ("result",))
+LLM_CIRCUIT_OPEN = Gauge("a3_llm_circuit_open", "AI 服务熔断状态（1 表示熔断中）")
+LLM_CACHE_HITS = Counter("a3_llm_cache_hits_total", "命中本地响应缓存、未调用 LLM 的次数", ("step", "model"))
+LLM_TOKENS = Counter("a3_llm_tokens_total", "LLM 返回的 token 用量", ("model", "type"))
+RENDER_DOC_SECONDS = Histogram("a3_render_doc_duration_seconds", "生成 Word 文档内容耗时")
+DOC_SAVE_SECONDS = Histogram("a3_doc_save_duration_seconds", "Word 文档序列化 / 写盘耗时", ("target",))
+REPORT_JOB_QUEUE_SECONDS = Histogram("a3_report_job_queue_seconds", "报告任务从提交到开始执行的排队时间")
+REPORT_JOBS = Counter("a3_report_jobs_total", "已结束的报告任务数", ("status",))
+
+
+@app.before_request
+def _bind_config_snapshot():
+    # 其它进程保存过配置时先重新加载；整个请求（包括流式响应）都使用这一份配置快照
+    config_watcher.check()
+    g.config_snapshot = _config_snapshot
+
+
+@app.before_request
+def _metrics_start():
+    g.metrics_started = time.perf_counter()
+    HTTP_IN_FLIGHT.inc()
+
+
+@app.after_request
+def _metrics_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def _metrics_finish(exc=None):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return
+    HTTP_IN_FLIGHT.dec()
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    HTTP_SECONDS.observe(
+        time.perf_counter() - started,
+        endpoint=endpoint,
+        method=request.method,
+        status=g.pop("metrics_status", 500),
+    )
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus 指标：需管理员登录，或携带 Authorization: Bearer <METRICS_TOKEN>
+
+    不接受 URL 参数形式的令牌，避免令牌出现在访问日志和浏览器历史中。
+    """
+    if not session.get("admin_logged_in"):
+        token = config.METRICS_TOKEN
+        auth = request.headers.get("Authorization", "")
+        supplied = auth[7:].strip() if auth.startswith("Bearer ") else ""
+        if not token or not hmac.compare_digest(supplied.encode(), token.encode()):
+            return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+# -------------------------------------------------------------
+# LLM 响应缓存
+
+_sqlite_local = threading.local()
+
+def sqlite_connect(path: Path) -> sqlite3.Connection:
+    """按线程复用 SQLite 连接（WAL 模式，允许多线程/多进程并发读写）"""
+    conns = getattr(_sqlite_local, "conns", None)
+    if conns is None:
+        conns = _sqlite_local.conns = {}
+    conn = conns.get(str(path))
+    if conn is None:
+        conn = sqlite3.connect(str(path), timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conns[str(path)] = conn
+    return conn
+
+
+@contextmanager
+def sqlite_transaction(conn: sqlite3.Connection):
+    """BEGIN IMMEDIATE 事务：读-改-写期间独占写锁，跨进程也不会交错"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def prompt_fingerprint() -> str:
+    """系统提示词与 A3 步骤定义的指纹，任一变化都会产生新值"""
+    return current_config().fingerprint
+
+
+class LLMResponseCache:
+    """LLM 响应缓存：内存 LRU + 可选 SQLite 持久化，按 (模型, Base URL, 完整消息) 的哈希寻址"""
+
+    def __init__(self, db_path: Optional[Path], version: str):
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._db_path = db_path
+        self._version = version
+        self._disk_writes = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if self._db_path is not None:
+            sqlite_connect(self._db_path).execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, version TEXT NOT NULL,"
+                " created REAL NOT NULL, content TEXT NOT NULL)"
+            )
+
+    def make_key(self, messages) -> str:
+        payload = json.dumps(
+            [current_config().model_name, current_config().base_url, self._version, messages],
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, messages) -> Optional[str]:
+        if not config.LLM_CACHE_ENABLED:
+            return None
+        key = self.make_key(messages)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, content = entry
+                if now - created <= config.LLM_CACHE_TTL:
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return content
+                del self._memory[key]
+        if self._db_path is not None:
+            row = sqlite_connect(self._db_path).execute(
+                "SELECT created, content FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[0] <= config.LLM_CACHE_TTL:
+                self._remember(key, row[0], row[1])
+                with self._lock:
+                    self.counters["disk_hits"] += 1
+                return row[1]
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, messages, content: str) -> None:
+        if not config.LLM_CACHE_ENABLED or not content:
+            return
+        key = self.make_key(messages)
+        created = time.time()
+        self._remember(key, created, content)
+        with self._lock:
+            self.counters["stores"] += 1
+        if self._db_path is not None:
+            conn = sqlite_connect(self._db_path)
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, version, created, content) VALUES (?, ?, ?, ?)",
+                (key, self._version, created, content),
+            )
+            self._disk_writes += 1
+            if self._disk_writes % 100 == 0:
+                self._prune_disk(conn)
+
+    def discard(self, messages) -> None:
+        key = self.make_key(messages)
+        with self._lock:
+            self._memory.pop(key, None)
+        if self._db_path is not None:
+            sqlite_connect(self._db_path).execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+
+    def _remember(self, key: str, created: float, content: str) -> None:
+        with self._lock:
+            self._memory[key] = (created, content)
+            self._memory.move_to_end(key)
+            while len(self._memory) > config.LLM_CACHE_MAX_ENTRIES:
+                self._memory.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def _prune_disk(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - config.LLM_CACHE_TTL,))
+        conn.execute(
+            "DELETE FROM llm_cache WHERE key NOT IN"
+            " (SELECT key FROM llm_cache ORDER BY created DESC LIMIT ?)",
+            (config.LLM_CACHE_DISK_MAX_ENTRIES,),
+        )
+
+    def set_version(self, version: str) -> None:
+        """提示词或 GUIDE 变化时清空旧版本的缓存条目"""
+        with self._lock:
+            if version == self._version:
+                return
+            self._version = version
+            self._memory.clear()
+        if self._db_path is not None:
+            sqlite_connect(self._db_path).execute("DELETE FROM llm_cache WHERE version != ?", (version,))
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        total = hits + stats["misses"]
+        stats["hits"] = hits
+        stats["hit_rate"] = f"{hits / total:.1%}" if total else "-"
+        return stats
+
+
+llm_cache = LLMResponseCache(
+    STATE_DIR / "llm_cache.sqlite3" if config.LLM_CACHE_DISK else None,
+    prompt_fingerprint(),
+)
+
+# -------------------------------------------------------------
+# 报告存储
+
+class ReportStore:
+    """输出目录中的报告存储：SQLite 元数据索引 + 按月份/ID 前缀分片的目录 + 保留策略"""
+
+    RETENTION_INTERVAL = 60  # 两次清理之间的最短间隔（秒）
+
+    def __init__(self, root: Path, db_path: Path):
+        self.root = root
+        self.db_path = db_path
+        self._last_retention = 0.0
+        conn = sqlite_connect(self.db_path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS reports ("
+            " id TEXT PRIMARY KEY, topic TEXT NOT NULL, filename TEXT NOT NULL,"
+            " inputs_hash TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, path TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS reports_created ON reports (created)")
+
+    def save(self, topic: str, filename: str, inputs_hash: str, data: bytes) -> str:
+        report_id = uuid.uuid4().hex
+        created = time.time()
+        rel_path = Path(f"{_dt.datetime.fromtimestamp(created):%Y%m}") / report_id[:2] / f"{report_id}.docx"
+        path = self.root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with DOC_SAVE_SECONDS.time(target="disk"):
+            path.write_bytes(data)
+        sqlite_connect(self.db_path).execute(
+            "INSERT INTO reports (id, topic, filename, inputs_hash, size, created, path)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (report_id, topic, filename, inputs_hash, len(data), created, rel_path.as_posix()),
+        )
+        if created - self._last_retention >= self.RETENTION_INTERVAL:
+            self._last_retention = created
+            self.enforce_retention()
+        return report_id
+
+    def get(self, report_id: str) -> Optional[Dict[str, object]]:
+        row = sqlite_connect(self.db_path).execute(
+            "SELECT id, topic, filename, inputs_hash, size, created, path FROM reports WHERE id = ?",
+            (report_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        keys = ("id", "topic", "filename", "inputs_hash", "size", "created", "path")
+        return dict(zip(keys, row))
+
+    def read(self, report_id: str):
+        meta = self.get(report_id)
+        if meta is None:
+            return None
+        try:
+            return meta, (self.root / meta["path"]).read_bytes()
+        except FileNotFoundError:
+            self._delete([report_id])
+            return None
+
+    def enforce_retention(self) -> int:
+        """按保存天数和总大小上限清理最旧的报告，返回删除数量"""
+        conn = sqlite_connect(self.db_path)
+        expired = []
+        if config.REPORT_RETENTION_DAYS > 0:
+            deadline = time.time() - config.REPORT_RETENTION_DAYS * 86400
+            expired += [row[0] for row in conn.execute(
+                "SELECT id FROM reports WHERE created < ?", (deadline,)
+            )]
+        if config.REPORT_RETENTION_MAX_MB > 0:
+            budget = config.REPORT_RETENTION_MAX_MB * 1024 * 1024
+            total = 0
+            # 从最新往前累加，超出容量的部分全部清理
+            for report_id, size in conn.execute("SELECT id, size FROM reports ORDER BY created DESC"):
+                total += size
+                if total > budget:
+                    expired.append(report_id)
+        self._delete(set(expired))
+        return len(set(expired))
+
+    def _delete(self, report_ids) -> None:
+        conn = sqlite_connect(self.db_path)
+        for report_id in report_ids:
+            row = conn.execute("SELECT path FROM reports WHERE id = ?", (report_id,)).fetchone()
+            if row is not None:
+                try:
+                    (self.root / row[0]).unlink()
+                except FileNotFoundError:
+                    pass
+            conn.execute("DELETE FROM reports WHERE id = ?", (report_id,))
+
+    def stats(self) -> Dict[str, object]:
+        count, total = sqlite_connect(self.db_path).execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM reports"
+        ).fetchone()
+        return {"count": count, "size_mb": f"{total / 1024 / 1024:.1f}"}
+
+
+report_store = ReportStore(OUTPUT_DIR, STATE_DIR / "reports.sqlite3")
+
+# -------------------------------------------------------------
+# 共享状态（多进程 / 多容器）
+
+class JobStore:
+    """报告任务状态、去重键和报告ID，保存在状态目录下的 SQLite（WAL）中，供所有工作进程共享
+
+    生成的文档不写入任务表：本进程生成的文档留在内存中直接下载，其它进程按报告ID从报告存储读取。
+    未结束的任务由所在进程定期刷新心跳；进程退出后心跳停止，任务视为中断，不再被复用。
+    """
+
+    PRUNE_INTERVAL = 60  # 两次清理之间的最短间隔（秒）
+    HEARTBEAT_INTERVAL = 10  # 刷新心跳的间隔（秒）
+    HEARTBEAT_STALE = 45  # 超过该时间（秒）没有心跳的未结束任务视为中断
+    MEMORY_REPORTS = 32  # 本进程内存中保留的已生成文档数
+    COLUMNS = ("status", "filename", "report_id", "error", "finished")
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+        self._owned = set()  # 本进程登记、尚未结束的任务
+        self._heartbeat_thread = None
+        self._reports: "OrderedDict[str, bytes]" = OrderedDict()  # 本进程生成的文档
+        conn = sqlite_connect(self.db_path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, key TEXT NOT NULL, status TEXT NOT NULL, topic TEXT NOT NULL,"
+            " filename TEXT, report_id TEXT, error TEXT, created REAL NOT NULL, finished REAL,"
+            " heartbeat REAL)"
+        )
+        if "heartbeat" not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+            conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, created)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_steps ("
+            " job_id TEXT NOT NULL, step_id TEXT NOT NULL, state TEXT NOT NULL,"
+            " PRIMARY KEY (job_id, step_id))"
+        )
+
+    def submit(self, key: str, steps: Dict[str, str], topic: str):
+        """返回 (任务ID, 是否复用)；查重和登记在同一个写事务中完成，多进程并发提交也只会创建一个任务"""
+        now = time.time()
+        conn = sqlite_connect(self.db_path)
+        with sqlite_transaction(conn):
+            if now - self._last_prune >= self.PRUNE_INTERVAL:
+                self._last_prune = now
+                self._prune(conn, now)
+            row = conn.execute(
+                "SELECT id, status, created, finished, heartbeat FROM jobs WHERE key = ? ORDER BY created DESC LIMIT 1",
+                (key,),
+            ).fetchone()
+            if row is not None and self._reusable(row[1], row[2], row[3], row[4], now):
+                return row[0], True
+            job_id = uuid.uuid4().hex[:12]
+            conn.execute(
+                "INSERT INTO jobs (id, key, status, topic, created, heartbeat) VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, key, topic, now, now),
+            )
+            conn.executemany(
+                "INSERT INTO job_steps (job_id, step_id, state) VALUES (?, ?, ?)",
+                [(job_id, step_id, state) for step_id, state in steps.items()],
+            )
+        self._own(job_id)
+        return job_id, False
+
+    @classmethod
+    def _reusable(cls, status: str, created: float, finished: Optional[float],
+                  heartbeat: Optional[float], now: float) -> bool:
+        if status in ("queued", "running"):
+            # 心跳停止说明所在进程已退出，任务不会再结束
+            return (heartbeat or created) >= now - cls.HEARTBEAT_STALE
+        # partial 任务含有失败的步骤，上游恢复后重新提交应重新生成
+        return status == "done" and finished >= now - config.REPORT_DEDUPE_TTL
+
+    def _own(self, job_id: str) -> None:
+        with self._lock:
+            self._owned.add(job_id)
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="a3-job-heartbeat", daemon=True)
+                self._heartbeat_thread.start()
+
+    def _heartbeat_loop(self) -> None:
+        while True:
+            time.sleep(self.HEARTBEAT_INTERVAL)
+            with self._lock:
+                owned = list(self._owned)
+            if not owned:
+                continue
+            try:
+                sqlite_connect(self.db_path).execute(
+                    f"UPDATE jobs SET heartbeat = ? WHERE id IN ({', '.join('?' * len(owned))})",
+                    [time.time()] + owned,
+                )
+            except sqlite3.Error as exc:
+                print(f"刷新任务心跳失败: {exc}")
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        conn = sqlite_connect(self.db_path)
+        row = conn.execute(
+            "SELECT id, key, status, topic, filename, report_id, error, created, finished, heartbeat"
+            " FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(
+            ("id", "key", "status", "topic", "filename", "report_id", "error", "created", "finished", "heartbeat"), row
+        ))
+        order = {g["id"]: idx for idx, g in enumerate(current_config().guide)}
+        steps = conn.execute("SELECT step_id, state FROM job_steps WHERE job_id = ?", (job_id,)).fetchall()
+        job["steps"] = dict(sorted(steps, key=lambda item: order.get(item[0], len(order))))
+        if job["status"] in ("queued", "running") and not self._reusable(
+                job["status"], job["created"], None, job["heartbeat"], time.time()):
+            job["status"] = "failed"
+            job["error"] = "任务已中断，请重新生成"
+        return job
+
+    def keep_report(self, job_id: str, data: bytes) -> None:
+        with self._lock:
+            self._reports[job_id] = data
+            while len(self._reports) > self.MEMORY_REPORTS:
+                self._reports.popitem(last=False)
+
+    def report(self, job: Dict) -> Optional[bytes]:
+        """任务生成的文档：优先取本进程内存，否则按报告ID从报告存储读取"""
+        with self._lock:
+            data = self._reports.get(job["id"])
+        if data is None and job["report_id"]:
+            found = report_store.read(job["report_id"])
+            data = found[1] if found else None
+        return data
+
+    def update(self, job_id: str, **fields) -> None:
+        columns = [name for name in fields if name in self.COLUMNS]
+        sqlite_connect(self.db_path).execute(
+            f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in columns)} WHERE id = ?",
+            [fields[name] for name in columns] + [job_id],
+        )
+        if "finished" in fields:
+            with self._lock:
+                self._owned.discard(job_id)
+
+    def set_step(self, job_id: str, step_id: str, state: str) -> None:
+        sqlite_connect(self.db_path).execute(
+            "UPDATE job_steps SET state = ? WHERE job_id = ? AND step_id = ?",
+            (state, job_id, step_id),
+        )
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> None:
+        """清理已结束且超过保留时间的任务，以及长期未结束的中断任务"""
+        deadline = now - config.REPORT_JOB_TTL
+        conn.execute(
+            "DELETE FROM jobs WHERE (finished IS NOT NULL AND finished < ?) OR created < ?",
+            (deadline, deadline - config.REPORT_JOB_TTL),
+        )
+        conn.execute("DELETE FROM job_steps WHERE job_id NOT IN (SELECT id FROM jobs)")
+
+
+job_store = JobStore(STATE_DIR / "state.sqlite3")
+
+# -------------------------------------------------------------
+# 服务端对话：AI 检查与追问的历史按会话和步骤保存，前端追问只需提交对话ID和问题
+
+class ConversationError(Exception):
+    """对话不存在、已过期或请求参数错误；status 为对应的 HTTP 状态码"""
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+class ConversationStore:
+    """AI 检查对话存储；每个会话的每个步骤只保留最新一次检查开始的对话，闲置超时后过期
+
+    启用 SQLite 持久化时以数据库为准（多进程部署各 worker 看到同一份对话），追加在同一个写事务中读-改-写；
+    未启用时保存在进程内存 LRU 中。
+    """
+
+    def __init__(self, db_path: Optional[Path]):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Dict]" = OrderedDict()
+        self._writes = 0
+        if self.db_path is not None:
+            conn = sqlite_connect(self.db_path)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " id TEXT PRIMARY KEY, owner TEXT NOT NULL, step_id TEXT NOT NULL,"
+                " inputs TEXT NOT NULL, messages TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS conversations_owner ON conversations (owner, step_id)")
+
+    def create(self, owner: str, step_id: str, inputs: Dict[str, str], messages: List[Dict[str, str]]) -> str:
+        conversation = {
+            "id": uuid.uuid4().hex,
+            "owner": owner,
+            "step_id": step_id,
+            "inputs": dict(inputs),
+            "messages": messages[-config.CONVERSATION_MAX_MESSAGES:],
+            "updated": time.time(),
+        }
+        if self.db_path is not None:
+            conn = sqlite_connect(self.db_path)
+            with sqlite_transaction(conn):
+                # 同一会话同一步骤重新检查时，旧对话作废
+                conn.execute("DELETE FROM conversations WHERE owner = ? AND step_id = ?", (owner, step_id))
+                self._write(conn, conversation)
+            return conversation["id"]
+        with self._lock:
+            stale = [cid for cid, c in self._memory.items() if c["owner"] == owner and c["step_id"] == step_id]
+            for cid in stale:
+                del self._memory[cid]
+            self._remember(conversation)
+        return conversation["id"]
+
+    def get(self, conversation_id: str) -> Optional[Dict]:
+        now = time.time()
+        if self.db_path is not None:
+            return self._load(sqlite_connect(self.db_path), conversation_id, now)
+        with self._lock:
+            conversation = self._memory.get(conversation_id)
+            if conversation is None:
+                return None
+            if now - conversation["updated"] > config.CONVERSATION_TTL:
+                del self._memory[conversation_id]
+                return None
+            self._memory.move_to_end(conversation_id)
+            return {**conversation, "messages": list(conversation["messages"])}
+
+    def append(self, conversation_id: str, messages: List[Dict[str, str]]) -> None:
+        now = time.time()
+        if self.db_path is not None:
+            conn = sqlite_connect(self.db_path)
+            with sqlite_transaction(conn):
+                conversation = self._load(conn, conversation_id, now)
+                if conversation is None:
+                    return
+                conversation["messages"] = (conversation["messages"] + messages)[-config.CONVERSATION_MAX_MESSAGES:]
+                conversation["updated"] = now
+                self._write(conn, conversation)
+            return
+        with self._lock:
+            conversation = self._memory.get(conversation_id)
+            if conversation is None or now - conversation["updated"] > config.CONVERSATION_TTL:
+                return
+            conversation["messages"] = (conversation["messages"] + messages)[-config.CONVERSATION_MAX_MESSAGES:]
+            conversation["updated"] = now
+            self._memory.move_to_end(conversation_id)
+
+    def _load(self, conn: sqlite3.Connection, conversation_id: str, now: float) -> Optional[Dict]:
+        row = conn.execute(
+            "SELECT owner, step_id, inputs, messages, updated FROM conversations WHERE id = ?",
+            (conversation_id,),
+        ).fetchone()
+        if row is None or now - row[4] > config.CONVERSATION_TTL:
+            return None
+        return {
+            "id": conversation_id,
+            "owner": row[0],
+            "step_id": row[1],
+            "inputs": json.loads(row[2]),
+            "messages": json.loads(row[3]),
+            "updated": row[4],
+        }
+
+    def _write(self, conn: sqlite3.Connection, conversation: Dict) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO conversations (id, owner, step_id, inputs, messages, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                conversation["id"], conversation["owner"], conversation["step_id"],
+                json.dumps(conversation["inputs"], ensure_ascii=False),
+                json.dumps(conversation["messages"], ensure_ascii=False),
+                conversation["updated"],
+            ),
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            conn.execute("DELETE FROM conversations WHERE updated < ?", (time.time() - config.CONVERSATION_TTL,))
+
+    def _remember(self, conversation: Dict) -> None:
+        """在持有锁时调用"""
+        self._memory[conversation["id"]] = conversation
+        self._memory.move_to_end(conversation["id"])
+        while len(self._memory) > config.CONVERSATION_MAX_ENTRIES:
+            self._memory.popitem(last=False)
+
+
+conversation_store = ConversationStore(
+    STATE_DIR / "state.sqlite3" if config.CONVERSATION_DISK else None
+)
+
+
+@dataclass
+class ValidationTurn:
+    """一次 AI 检查或追问：history 已包含本次的问题；conversation_id 为空表示新对话"""
+    owner: str
+    step_id: str
+    inputs: Dict[str, str]
+    history: List[Dict[str, str]]
+    conversation_id: Optional[str] = None
+
+    @property
+    def followup(self) -> bool:
+        return bool(self.history)
+
+
+def begin_validation_turn(data: Dict, owner: str) -> ValidationTurn:
+    """解析 AI 检查 / 追问请求
+
+    - 追问：{"conversation_id", "question"}，历史和已填写内容取自服务端保存的对话；
+    - 新检查：{"step_id", "inputs"}，可附带 question；仍兼容旧版前端提交的完整 history。
+    """
+    if not isinstance(data, dict):
+        raise ConversationError("参数错误", 400)
+    question = data.get("question")
+    question = question.strip() if isinstance(question, str) else ""
+    conversation_id = data.get("conversation_id")
+    if conversation_id:
+        conversation = conversation_store.get(str(conversation_id))
+        if conversation is None or conversation["owner"] != owner:
+            raise ConversationError("对话已过期，请重新点击“AI 检查”", 410)
+        if not question:
+            raise ConversationError("请输入追问内容", 400)
+        if conversation["step_id"] not in current_config().guide_map:
+            raise ConversationError("该步骤已不存在，请刷新页面", 410)
+        return ValidationTurn(
+            owner=owner,
+            step_id=conversation["step_id"],
+            inputs=conversation["inputs"],
+            history=conversation["messages"] + [{"role": "user", "content": question}],
+            conversation_id=conversation["id"],
+        )
+    step_id = data.get("step_id")
+    if step_id not in current_config().guide_map:
+        raise ConversationError("参数错误", 400)
+    inputs = data.get("inputs")
+    inputs = {k: v for k, v in inputs.items() if isinstance(v, str)} if isinstance(inputs, dict) else {}
+    history = data.get("history") if isinstance(data.get("history"), list) else []
+    if question:
+        history = history + [{"role": "user", "content": question}]
+    return ValidationTurn(owner=owner, step_id=step_id, inputs=inputs, history=history)
+
+
+def finish_validation_turn(turn: ValidationTurn, reply: str) -> str:
+    """保存本轮问答，返回对话ID"""
+    answer = {"role": "assistant", "content": reply}
+    if turn.conversation_id is not None:
+        conversation_store.append(turn.conversation_id, [turn.history[-1], answer])
+        return turn.conversation_id
+    history = [
+        {"role": msg["role"], "content": msg["content"]}
+        for msg in turn.history
+        if isinstance(msg, dict) and msg.get("role") in ("user", "assistant")
+        and isinstance(msg.get("content"), str) and msg["content"]
+    ]
+    return conversation_store.create(turn.owner, turn.step_id, turn.inputs, history + [answer])
+
+# -------------------------------------------------------------
+# 相似步骤复用：近似重复的步骤内容直接复用以往生成的建议
+
+class SimilarityIndex:
+    """按步骤区分的近似重复索引：字符 n-gram + MinHash 签名 + LSH 分桶，不依赖外部服务
+
+    - 新条目逐条插入，内存中最多 max_entries 条，超出时按最近使用淘汰并从分桶中移除；
+    - 候选条目再按 n-gram 集合的 Jaccard 相似度精确比较，达到阈值才复用；
+    - 条目（含签名）同时写入 SQLite，重启后无需重新计算签名即可恢复。
+    提示词或步骤定义变化后（配置指纹不同），旧条目不再参与匹配。
+    """
+
+    NGRAM = 3
+    BANDS = 16
+    ROWS = 4
+    MIN_SHINGLES = 8  # 内容过短时不做相似匹配
+    _PRIME = (1 << 61) - 1
+    _NORMALIZE_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+
+    def __init__(self, db_path: Optional[Path], max_entries: int):
+        self.db_path = db_path
+        self.max_entries = max(1, max_entries)
+        rng = random.Random(0xA3)
+        perms = self.BANDS * self.ROWS
+        self._a = [rng.randrange(1, self._PRIME) for _ in range(perms)]
+        self._b = [rng.randrange(0, self._PRIME) for _ in range(perms)]
+        self._signature_format = f"<{perms}Q"
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, Tuple]" = OrderedDict()
+        self._buckets: Dict[Tuple, set] = {}
+        self._next_id = 0
+        self._loaded = False
+        self._writes = 0
+        self.counters = {"lookups": 0, "hits": 0, "inserts": 0, "evictions": 0}
+        if self.db_path is not None:
+            sqlite_connect(self.db_path).execute(
+                "CREATE TABLE IF NOT EXISTS similar_steps ("
+                " version TEXT NOT NULL, step_id TEXT NOT NULL, text TEXT NOT NULL,"
+                " suggestion TEXT NOT NULL, signature BLOB NOT NULL, updated REAL NOT NULL,"
+                " PRIMARY KEY (version, step_id, text))"
+            )
+
+    def shingles(self, text: str) -> set:
+        normalized = self._NORMALIZE_RE.sub("", text.lower())
+        return {normalized[i:i + self.NGRAM] for i in range(max(0, len(normalized) - self.NGRAM + 1))}
+
+    def signature(self, shingles: set) -> Tuple[int, ...]:
+        hashes = [
+            int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "little")
+            for item in shingles
+        ]
+        prime = self._PRIME
+        return tuple(min((a * h + b) % prime for h in hashes) for a, b in zip(self._a, self._b))
+
+    def sketch(self, text: str) -> Optional[Tuple[set, Tuple[int, ...]]]:
+        """n-gram 集合和 MinHash 签名，内容过短时返回 None；查询和插入共用，同一内容只计算一次"""
+        shingles = self.shingles(text)
+        if len(shingles) < self.MIN_SHINGLES:
+            return None
+        return shingles, self.signature(shingles)
+
+    def lookup(self, step_id: str, sketch: Optional[Tuple[set, Tuple[int, ...]]], threshold: float) -> Optional[str]:
+        """返回相似度不低于 threshold 的以往建议，没有时返回 None"""
+        if sketch is None:
+            return None
+        self.load()
+        shingles, signature = sketch
+        version = current_config().fingerprint
+        best, best_score = None, 0.0
+        with self._lock:
+            self.counters["lookups"] += 1
+            candidates = set()
+            for band_key in self._band_keys(version, step_id, signature):
+                candidates |= self._buckets.get(band_key, set())
+            for entry_id in candidates:
+                entry_text, suggestion = self._entries[entry_id][2:4]
+                other = self.shingles(entry_text)
+                score = len(shingles & other) / len(shingles | other)
+                if score > best_score:
+                    best, best_score = entry_id, score
+            if best is None or best_score < threshold:
+                SIMILAR_LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(best)
+            self.counters["hits"] += 1
+            suggestion = self._entries[best][3]
+        SIMILAR_LOOKUPS.inc(result="hit")
+        return suggestion
+
+    def add(self, step_id: str, text: str, suggestion: str, sketch: Optional[Tuple[set, Tuple[int, ...]]]) -> None:
+        if sketch is None or not suggestion:
+            return
+        self.load()
+        version = current_config().fingerprint
+        signature = sketch[1]
+        self._insert(version, step_id, text, suggestion, signature)
+        if self.db_path is not None:
+            conn = sqlite_connect(self.db_path)
+            conn.execute(
+                "INSERT OR REPLACE INTO similar_steps (version, step_id, text, suggestion, signature, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (version, step_id, text, suggestion, struct.pack(self._signature_format, *signature), time.time()),
+            )
+            with self._lock:
+                self._writes += 1
+                prune = self._writes % 100 == 0
+            if prune:
+                conn.execute(
+                    "DELETE FROM similar_steps WHERE rowid NOT IN"
+                    " (SELECT rowid FROM similar_steps ORDER BY updated DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+
+    def load(self) -> None:
+        """从 SQLite 恢复最近的条目（只执行一次）"""
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        if self.db_path is None:
+            return
+        rows = sqlite_connect(self.db_path).execute(
+            "SELECT version, step_id, text, suggestion, signature FROM similar_steps"
+            " WHERE version = ? ORDER BY updated DESC LIMIT ?",
+            (current_config().fingerprint, self.max_entries),
+        ).fetchall()
+        for version, step_id, text, suggestion, signature in reversed(rows):
+            self._insert(version, step_id, text, suggestion, struct.unpack(self._signature_format, signature))
+
+    def set_version(self, version: str) -> None:
+        """配置变化后清除旧版本的条目"""
+        with self._lock:
+            stale = [entry_id for entry_id, entry in self._entries.items() if entry[0] != version]
+            for entry_id in stale:
+                self._remove(entry_id)
+        if self.db_path is not None:
+            sqlite_connect(self.db_path).execute("DELETE FROM similar_steps WHERE version != ?", (version,))
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+        stats["hit_rate"] = f"{stats['hits'] / stats['lookups']:.1%}" if stats["lookups"] else "-"
+        return stats
+
+    def _band_keys(self, version: str, step_id: str, signature: Tuple[int, ...]):
+        for band in range(self.BANDS):
+            yield (version, step_id, band) + signature[band * self.ROWS:(band + 1) * self.ROWS]
+
+    def _insert(self, version: str, step_id: str, text: str, suggestion: str, signature: Tuple[int, ...]) -> None:
+        with self._lock:
+            # 同一步骤的相同内容只保留最新的建议
+            for entry_id in list(self._buckets.get(next(self._band_keys(version, step_id, signature)), ())):
+                if self._entries[entry_id][2] == text:
+                    self._remove(entry_id)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (version, step_id, text, suggestion, signature)
+            for band_key in self._band_keys(version, step_id, signature):
+                self._buckets.setdefault(band_key, set()).add(entry_id)
+            self.counters["inserts"] += 1
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def _remove(self, entry_id: int) -> None:
+        version, step_id, _, _, signature = self._entries.pop(entry_id)
+        for band_key in self._band_keys(version, step_id, signature):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band_key]
+
+
+similarity_index = SimilarityIndex(STATE_DIR / "state.sqlite3", config.SIMILARITY_MAX_ENTRIES)
+
+# -------------------------------------------------------------
+# 报告草稿
+
+class DraftStore:
+    """服务端草稿：按会话记录每个步骤的请求指纹及对应的优化建议，重新生成时只优化有变化的步骤"""
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.counters = {"reused": 0, "called": 0}
+        sqlite_connect(self.db_path).execute(
+            "CREATE TABLE IF NOT EXISTS drafts ("
+            " draft_id TEXT NOT NULL, step_id TEXT NOT NULL, fingerprint TEXT NOT NULL,"
+            " suggestion TEXT NOT NULL, updated REAL NOT NULL,"
+            " PRIMARY KEY (draft_id, step_id))"
+        )
+
+    def get(self, draft_id: str, step_id: str, fingerprint: str) -> Optional[str]:
+        row = sqlite_connect(self.db_path).execute(
+            "SELECT fingerprint, suggestion FROM drafts WHERE draft_id = ? AND step_id = ?",
+            (draft_id, step_id),
+        ).fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        return row[1]
+
+    def put(self, draft_id: str, step_id: str, fingerprint: str, suggestion: str) -> None:
+        conn = sqlite_connect(self.db_path)
+        conn.execute(
+            "INSERT OR REPLACE INTO drafts (draft_id, step_id, fingerprint, suggestion, updated)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (draft_id, step_id, fingerprint, suggestion, time.time()),
+        )
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % 100 == 0
+        if prune:
+            conn.execute("DELETE FROM drafts WHERE updated < ?", (time.time() - config.DRAFT_TTL_DAYS * 86400,))
+
+    def record(self, reused: int, called: int) -> None:
+        with self._lock:
+            self.counters["reused"] += reused
+            self.counters["called"] += called
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            stats = dict(self.counters)
+        total = stats["reused"] + stats["called"]
+        stats["saved_rate"] = f"{stats['reused'] / total:.1%}" if total else "-"
+        return stats
+
+
+draft_store = DraftStore(STATE_DIR / "drafts.sqlite3")
+
+# -------------------------------------------------------------
+# Word 基础模板
+
+DOC_TEMPLATE_STYLES = ("Normal", "Title", "Heading 1", "Heading 2", "Intense Quote")
+
+# (字体名, 模板 .docx 字节, 样式名 -> 样式 ID)，字体变化时重新生成
+_doc_template = (None, None, None)
+_doc_template_lock = threading.Lock()
+
+def doc_template():
+    """返回预先设置好字体样式的基础模板及样式 ID，每份报告从它复制而来"""
+    global _doc_template
+    font_name = current_config().doc_font_name
+    cached_font, data, style_ids = _doc_template
+    if data is not None and cached_font == font_name:
+        return data, style_ids
+    with _doc_template_lock:
+        cached_font, data, style_ids = _doc_template
+        if data is None or cached_font != font_name:
+            data, style_ids = build_doc_template(font_name)
+            _doc_template = (font_name, data, style_ids)
+        return data, style_ids
+
+
+def build_doc_template(font_name: str):
+    from docx import Document
+    from docx.oxml.ns import qn
+
+    doc = Document()
+    # 文档默认字体（含 eastAsia），未指定样式的文字也使用该字体
+    r_pr_default = doc.styles.element.find(qn("w:docDefaults") + "/" + qn("w:rPrDefault") + "/" + qn("w:rPr"))
+    if r_pr_default is not None:
+        set_rfonts(r_pr_default.get_or_add_rFonts(), font_name)
+    style_ids = {}
+    for style_name in DOC_TEMPLATE_STYLES:
+        style = doc.styles[style_name]
+        style.font.name = font_name
+        set_rfonts(style.element.rPr.rFonts, font_name)
+        style_ids[style_name] = style.style_id
+    return doc_to_bytes(doc), style_ids
+
+
+def set_rfonts(r_fonts, font_name: str) -> None:
+    """设置西文与东亚字体，并移除会覆盖显式字体的主题字体属性"""
+    from docx.oxml.ns import qn
+
+    for attr in ("w:ascii", "w:hAnsi", "w:eastAsia"):
+        r_fonts.set(qn(attr), font_name)
+    for attr in ("w:asciiTheme", "w:hAnsiTheme", "w:eastAsiaTheme"):
+        r_fonts.attrib.pop(qn(attr), None)
+
+# -------------------------------------------------------------
+# 启动预热
+
+class Warmup:
+    """后台预热：导入 openai / python-docx、建立 LLM 连接、生成 Word 基础模板、加载相似步骤索引
+
+    预热完成前 /readyz 返回 503，/healthz 只表示进程存活。
+    LLM 连接失败（如网络暂不可用）不影响就绪，首次调用时会重新建立连接。
+    """
+
+    OPTIONAL_STEPS = {"llm_pool", "similarity_index"}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.done = threading.Event()
+        self.steps: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self.seconds: Optional[float] = None
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="a3-warmup", daemon=True)
+                self._thread.start()
+
+    def run(self) -> None:
+        started = time.perf_counter()
+        for name, func in (
+            ("import_openai", _warm_import_openai),
+            ("import_docx", _warm_import_docx),
+            ("llm_pool", _warm_llm_pool),
+            ("docx_template", doc_template),
+            ("similarity_index", lambda: similarity_index.load()),
+        ):
+            step_started = time.perf_counter()
+            try:
+                func()
+            except Exception as exc:
+                self.errors[name] = str(exc)
+            self.steps[name] = round(time.perf_counter() - step_started, 3)
+        self.seconds = round(time.perf_counter() - started, 3)
+        self.done.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.done.is_set() and not (set(self.errors) - self.OPTIONAL_STEPS)
+
+
+def _warm_import_openai() -> None:
+    import httpx  # noqa: F401
+    import openai  # noqa: F401
+
+
+def _warm_import_docx() -> None:
+    import docx  # noqa: F401
+    import docx.enum.text  # noqa: F401
+
+
+def _warm_llm_pool() -> None:
+    """创建连接池客户端并发一次轻量请求（GET /models），提前完成 TCP / TLS 握手"""
+    client = llm_clients.get()
+    if config.LLM_PREWARM_CONNECT:
+        client.with_options(timeout=config.LLM_PREWARM_TIMEOUT, max_retries=0).models.list()
+
+
+warmup = Warmup()
+
+
+@app.route("/healthz")
+def healthz():
+    """存活检查：进程能处理请求即返回 200"""
+    return jsonify({"status": "ok"})
+
+
+@app.route("/readyz")
+def readyz():
+    """就绪检查：后台预热完成后返回 200，之前返回 503"""
+    warmup.start()
+    payload = {"steps": warmup.steps, "errors": warmup.errors, "warmup_seconds": warmup.seconds}
+    if warmup.ready:
+        return jsonify({"status": "ready", **payload})
+    return jsonify({"status": "failed" if warmup.done.is_set() else "warming", **payload}), 503
+
+
+def startup_time_cli(argv: List[str]) -> int:
+    """测量模块导入和预热耗时，输出 JSON；指定 -o 时追加到 JSONL 文件便于跨版本对比"""
+    parser = argparse.ArgumentParser(prog="A3.py startup-time", description="测量启动耗时")
+    parser.add_argument("-o", "--output", help="追加写入的 JSONL 文件")
+    args = parser.parse_args(argv)
+    warmup.run()
+    result = {
+        "timestamp": _dt.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "module_import_seconds": round(MODULE_IMPORT_SECONDS, 3),
+        "warmup_seconds": warmup.seconds,
+        "warmup_steps": warmup.steps,
+        "warmup_errors": warmup.errors,
+        "total_seconds": round(time.perf_counter() - _MODULE_STARTED, 3),
+    }
+    line = json.dumps(result, ensure_ascii=False)
+    print(line)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    return 0 if warmup.ready else 1
+
+# -------------------------------------------------------------
+# 批量生成
+
+BATCH_META_FIELDS = ("id", "topic")
+
+class RateLimiter:
+    """令牌桶限速：每分钟最多 rate_per_minute 次，<= 0 表示不限速"""
+
+    def __init__(self, rate_per_minute: float, burst: int = 1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, float(burst))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # 先预占令牌，令牌为负时按排队顺序依次等待
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SharedRateLimiter(RateLimiter):
+    """令牌桶状态保存在共享 SQLite 中，同一输出目录下的所有进程共用一个限速额度"""
+
+    def __init__(self, db_path: Path, name: str, rate_per_minute: float, burst: int = 1):
+        super().__init__(rate_per_minute, burst)
+        self.db_path = db_path
+        self.name = name
+        sqlite_connect(self.db_path).execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        conn = sqlite_connect(self.db_path)
+        with sqlite_transaction(conn):
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM rate_limits WHERE name = ?", (self.name,)).fetchone()
+            tokens, updated = row if row is not None else (self.capacity, now)
+            # 先预占令牌，令牌为负时按排队顺序依次等待
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate) - 1
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (name, tokens, updated) VALUES (?, ?, ?)",
+                (self.name, tokens, now),
+            )
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
+
+# 所有批量任务共享同一个限速线程池
+batch_executor = ThreadPoolExecutor(
+    max_workers=max(1, config.BATCH_MAX_CONCURRENCY),
+    thread_name_prefix="a3-batch",
+)
+batch_rate_limiter = SharedRateLimiter(
+    STATE_DIR / "state.sqlite3", "batch", config.BATCH_RATE_PER_MINUTE, burst=config.BATCH_MAX_CONCURRENCY
+)
+
+
+def parse_batch_file(filename: str, data: bytes) -> List[Dict[str, object]]:
+    """解析批量输入：JSONL 每行一个对象，CSV 以表头列名对应 GUIDE 步骤ID"""
+    text = data.decode("utf-8-sig")
+    rows: List[Dict[str, object]] = []
+    if filename.lower().endswith(".csv"):
+        rows = [dict(row) for row in csv.DictReader(io.StringIO(text))]
     else:
+        for line_no, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as exc:
+                raise ValueError(f"第 {line_no} 行不是合法的 JSON：{exc}")
+            if not isinstance(row, dict):
+                raise ValueError(f"第 {line_no} 行应为 JSON 对象")
+            # 同时支持 {"id": ..., "inputs": {...}} 的写法
+            if isinstance(row.get("inputs"), dict):
+                row = {**row.pop("inputs"), **row}
+            rows.append(row)
+    if not rows:
+        raise ValueError("文件中没有可处理的报告")
+    if len(rows) > config.BATCH_MAX_REPORTS:
+        raise ValueError(f"单次最多处理 {config.BATCH_MAX_REPORTS} 份报告")
+
+    cfg = current_config()
+    records = []
+    for index, row in enumerate(rows, 1):
+        user_inputs = {g["id"]: str(row.get(g["id"]) or "").strip() for g in cfg.guide}
+        unknown = sorted(k for k in row if k not in cfg.guide_map and k not in BATCH_META_FIELDS)
+        records.append({
+            "index": index,
+            "id": str(row.get("id") or index),
+            "topic": str(row.get("topic") or user_inputs.get("step1") or "A3_Topic")[:30],
+            "inputs": user_inputs,
+            "unknown_fields": unknown,
+        })
+    return records
+
+
+class _ZipStream:
+    """只追加的写入缓冲区，供 zipfile 以流式（非 seek）方式写 ZIP"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _rate_limited_call(prompt: str, step_id: str, owner: str, stop: threading.Event) -> str:
+    batch_rate_limiter.acquire()
+    # 限速等待期间批量任务可能已被放弃（客户端断开），此时不再调用 LLM
+    if stop.is_set():
+        raise RuntimeError("批量任务已取消")
+    return call_deepseek(prompt, step_id=step_id, priority=PRIORITY_BATCH, owner=owner)
+
+
+def iter_batch_zip(records: List[Dict[str, object]], owner: str = "batch"):
+    """所有报告的所有步骤共用限速线程池；每份报告完成后立即写入 ZIP 并产出已生成的字节
+
+    客户端中途断开时生成器被关闭，尚未开始的步骤随之取消，不再占用线程池和 LLM 额度。
+    """
+    cfg = current_config()
+    stop = threading.Event()
+    stream = _ZipStream()
+    archive = zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED)
+    manifest = []
+    pending: Dict[int, int] = {}
+    suggestions: Dict[int, Dict[str, str]] = {}
+    errors: Dict[int, Dict[str, str]] = {}
+    futures = {}
+
+    def finish(record) -> None:
+        result = suggestions[record["index"]]
+        failed = errors[record["index"]]
+        entry = {
+            "id": record["id"],
+            "topic": record["topic"],
+            "status": "partial" if failed else "done",
+            "failed_steps": list(failed),
+            "errors": dict(failed),
+        }
+        if record["unknown_fields"]:
+            entry["unknown_fields"] = record["unknown_fields"]
+        try:
+            filled = {sid: result.get(sid, "(用户未填写)") for sid in cfg.guide_map if sid not in failed}
+            data = doc_to_bytes(render_doc(record["topic"], record["inputs"], filled))
+            entry["file"] = f"{record['index']:03d}_{sanitize_filename(record['topic'])}.docx"
+            archive.writestr(entry["file"], data)
+        except Exception as exc:
+            entry["status"] = "failed"
+            entry["error"] = f"生成报告时发生错误：{exc}"
+        manifest.append(entry)
+
+    by_index = {record["index"]: record for record in records}
+    for record in records:
+        suggestions[record["index"]] = {}
+        errors[record["index"]] = {}
+        steps = [st for st in cfg.guide if record["inputs"].get(st["id"])]
+        pending[record["index"]] = len(steps)
+        for st in steps:
+            prompt = optimization_prompt(st, record["inputs"][st["id"]])
+            future = batch_executor.submit(run_with_config, cfg, _rate_limited_call, prompt, st["id"], owner, stop)
+            futures[future] = (record["index"], st["id"])
+
+    # 没有任何填写内容的报告不生成文档，只记录在清单中
+    for record in records:
+        if pending[record["index"]] == 0:
+            manifest.append({
+                "id": record["id"],
+                "topic": record["topic"],
+                "status": "skipped",
+                "error": "没有填写任何步骤",
+            })
+
+    try:
+        for future in as_completed(futures):
+            index, step_id = futures[future]
+            try:
+                suggestions[index][step_id] = future.result()
+            except Exception as exc:
+                errors[index][step_id] = str(exc)
+            pending[index] -= 1
+            if pending[index] == 0:
+                finish(by_index[index])
+                yield stream.drain()
+    finally:
+        stop.set()
+        cancelled = sum(future.cancel() for future in futures)
+        if cancelled:
+            print(f"[batch] 客户端已断开，取消 {cancelled} 个尚未开始的步骤")
+
+    manifest.sort(key=lambda entry: entry.get("file") or entry["id"])
+    archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+    archive.close()
+    yield stream.drain()
+
+
+def batch_cli(argv: List[str]) -> int:
+    """命令行批量生成：python A3.py batch 输入.jsonl -o 输出.zip"""
+    parser = argparse.ArgumentParser(prog="A3.py batch", description="批量生成 A3 报告")
+    parser.add_argument("input", help="JSONL 或 CSV 文件，字段名为 GUIDE 步骤ID（可选 id / topic）")
+    parser.add_argument("-o", "--output", help="输出 ZIP 文件路径，默认与输入文件同名")
+    args = parser.parse_args(argv)
+
+    input_path = Path(args.input)
+    output_path = Path(args.output) if args.output else input_path.with_suffix(".zip")
+    try:
+        records = parse_batch_file(input_path.name, input_path.read_bytes())
+    except (OSError, ValueError) as exc:
+        print(f"读取输入失败: {exc}")
+        return 1
+    print(f"共 {len(records)} 份报告，开始生成...")
+    with open(output_path, "wb") as f:
+        for chunk in iter_batch_zip(records, owner="cli"):
+            f.write(chunk)
+    print(f"已生成: {output_path}")
+    return 0
+
+# -------------------------------------------------------------
+# 异步服务（ASGI）：uvicorn A3:asgi_app
+#
+# AI 检查 / 追问在事件循环中等待上游，单个进程可以同时挂起大量调用而不占用线程；
+# 其余路由（页面、管理后台、报告下载等）仍由 Flask 处理，经 a2wsgi 在线程池中运行。
+# 对话存储、响应缓存等会访问 SQLite 的调用通过 asyncio.to_thread 执行，等待写锁时不阻塞事件循环。
+
+ASYNC_ROUTES: Dict[Tuple[str, str], object] = {}
+
+
+def async_route(path: str, method: str = "POST"):
+    """注册在事件循环中处理的路由；同一路径须保留 Flask 路由，WSGI 部署时由后者处理"""
+    def decorator(f):
+        ASYNC_ROUTES[(method, path)] = f
+        return f
+    return decorator
+
+
+@async_route("/validate")
+@require_access
+async def validate_async():
+    """/validate 的异步版本"""
+    try:
+        turn, precheck = await asyncio.to_thread(start_validation)
+    except ConversationError as exc:
+        return conversation_error_response(exc)
+    if precheck.answer is not None:
+        conversation_id = await asyncio.to_thread(finish_validation_turn, turn, precheck.answer)
+        return jsonify({"suggestion": precheck.answer, "local": True, "conversation_id": conversation_id})
+    messages = build_validation_messages(turn.step_id, turn.inputs, turn.history, findings=precheck.hints)
+    try:
+        suggestion = await call_deepseek_multi_async(messages, step_id=turn.step_id, owner=turn.owner)
+    except LLMBusyError as exc:
+        return busy_response(exc)
+    except LLMCallError as exc:
+        return llm_error_response(exc)
+    conversation_id = await asyncio.to_thread(finish_validation_turn, turn, suggestion)
+    return jsonify({"suggestion": suggestion, "conversation_id": conversation_id})
+
+
+@async_route("/validate/stream")
+@require_access
+async def validate_stream_async():
+    """/validate/stream 的异步版本：响应体为异步生成器，客户端断开时立即取消上游调用"""
+    try:
+        turn, precheck = await asyncio.to_thread(start_validation)
+    except ConversationError as exc:
+        return conversation_error_response(exc)
+    if precheck.answer is not None:
+        conversation_id = await asyncio.to_thread(finish_validation_turn, turn, precheck.answer)
+        return Response(
+            sse_event({"done": True, "suggestion": precheck.answer, "local": True, "conversation_id": conversation_id}),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+    messages = build_validation_messages(turn.step_id, turn.inputs, turn.history, findings=precheck.hints)
+
+    async def events():
+        parts = []
+        try:
+            async for delta in stream_deepseek_multi_async(messages, step_id=turn.step_id, owner=turn.owner):
+                if isinstance(delta, LLMQueued):
+                    yield sse_event({"queue_position": delta.position})
+                    continue
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+        except LLMBusyError as exc:
+            yield sse_event({"error": str(exc), "queue_position": exc.position, "retry_after": exc.retry_after})
+            return
+        except LLMCallError as exc:
+            yield sse_event(llm_error_payload(exc))
+            return
+        suggestion = "".join(parts).strip()
+        conversation_id = await asyncio.to_thread(finish_validation_turn, turn, suggestion)
+        yield sse_event({"done": True, "suggestion": suggestion, "conversation_id": conversation_id})
+
+    response = Response(mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.async_body = events()
+    return response
+
+
+class AsgiApp:
+    """ASGI 入口：ASYNC_ROUTES 中的路由在事件循环中处理，其余请求交给 Flask
+
+    异步路由同样在 Flask 请求上下文中执行，会话、require_access、配置快照和请求指标与 WSGI 部署一致。
+    """
+
+    def __init__(self, flask_app: Flask):
+        self.flask_app = flask_app
+        self._wsgi = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        handler = ASYNC_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if handler is None:
+            await self.wsgi()(scope, receive, send)
+            return
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        await self._handle(handler, asgi_environ(scope, bytes(body)), receive, send)
+
+    def wsgi(self):
+        if self._wsgi is None:
+            from a2wsgi import WSGIMiddleware
+            self._wsgi = WSGIMiddleware(self.flask_app, workers=max(1, config.WEB_THREADS))
+        return self._wsgi
+
+    async def _handle(self, handler, environ: Dict, receive, send) -> None:
+        """与 Flask.wsgi_app 相同的处理顺序：before_request → 视图 → after_request / 保存会话 → teardown"""
+        flask_app = self.flask_app
+        ctx = flask_app.request_context(environ)
+        error = None
+        ctx.push()
+        try:
+            try:
+                try:
+                    rv = flask_app.preprocess_request()
+                    if rv is None:
+                        rv = handler()
+                        if inspect.isawaitable(rv):
+                            rv = await rv
+                except Exception as exc:
+                    rv = flask_app.handle_user_exception(exc)
+                response = flask_app.finalize_request(rv)
+            except Exception as exc:
+                error = exc
+                response = flask_app.handle_exception(exc)
+            await send_asgi_response(response, receive, send)
+        finally:
+            ctx.pop(error)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if not (os.getenv("DEEPSEEK_API_KEY") or config.DEEPSEEK_API_KEY):
+                    await send({"type": "lifespan.startup.failed", "message": "未设置 DEEPSEEK_API_KEY 环境变量"})
+                    return
+                # 与 gunicorn 的 post_worker_init 相同：启动后在后台预热
+                warmup.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def asgi_environ(scope: Dict, body: bytes) -> Dict[str, object]:
+    """由 ASGI scope 构造 WSGI environ，用于建立 Flask 请求上下文"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", ()):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def send_asgi_response(response: Response, receive, send) -> None:
+    headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response.headers.items()]
+    await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+    body = getattr(response, "async_body", None)
+    if body is None:
+        await send({"type": "http.response.body", "body": response.get_data()})
+        return
+
+    async def pump():
+        async for chunk in body:
+            await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    streaming = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({streaming, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # 客户端断开时取消输出，生成器中的 finally 会归还调度名额并关闭上游连接
+        streaming.cancel()
+        watcher.cancel()
+        await asyncio.gather(streaming, watcher, return_exceptions=True)
+    if not streaming.cancelled() and streaming.exception() is not None:
+        raise streaming.exception()
+
+
+asgi_app = AsgiApp(app)
+
+# -------------------------------------------------------------
+MODULE_IMPORT_SECONDS = time.perf_counter() - _MODULE_STARTED
+
+if __name__ == "__main__":
+    ensure_api_key()
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        sys.exit(batch_cli(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "startup-time":
+        sys.exit(startup_time_cli(sys.argv[2:]))
+    warmup.start()
+    # 从配置读取主机和端口
+    host = config.HOST
+    port = config.PORT
+    webbrowser.open(f"http://localhost:{port}")
+    if config.WEB_SERVER == "flask" and not getattr(sys, "frozen", False):
+        # Flask 开发服务器，仅用于本地调试
         app.run(host=host, port=port, debug=False)
+    elif config.WEB_SERVER == "uvicorn":
+        # 异步服务：AI 检查在事件循环中处理，其余路由由 Flask 线程池处理
+        import uvicorn
+        uvicorn.run(asgi_app, host=host, port=port)
+    else:
+        from waitress import serve
+        serve(app, host=host, port=port, threads=max(1, config.WEB_THREADS))
@@ -0,0 +1,86 @@
+"""
+Word 文档生成微基准
+==================
+对比旧版逐 run 设置字体的生成方式与基于预置模板样式的 render_doc()。
+
+用法：python benchmarks/bench_build_doc.py [--chars 3000] [--rounds 20]
+"""
+
+from __future__ import annotations
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DEEPSEEK_API_KEY", "benchmark")
+
+from docx import Document
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.oxml.ns import qn
+
+import A3
+import config
+
+
+def legacy_render_doc(topic, user_inputs, suggestions):
+    """旧实现：新建空白文档并逐个 run 修改 rPr.rFonts"""
+    def set_font(run):
+        run.font.name = config.DOC_FONT_NAME
+        run._element.rPr.rFonts.set(qn('w:eastAsia'), config.DOC_FONT_NAME)
+
+    doc = Document()
+    h = doc.add_heading(config.DOC_TITLE_TEMPLATE.format(topic=topic), level=1)
+    h.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    for run in h.runs:
+        set_font(run)
+    for idx, st in enumerate(config.GUIDE, 1):
+        for p in (
+            doc.add_heading(f"Step {idx}: {st['title']}", level=2),
+            doc.add_paragraph(user_inputs.get(st["id"], "(用户未填写)")),
+            doc.add_paragraph("优化建议：", style="Intense Quote"),
+            doc.add_paragraph(suggestions.get(st["id"], "-")),
+        ):
+            for run in p.runs:
+                set_font(run)
+    return doc
+
+
+def timed(func, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chars", type=int, default=3000, help="每个步骤输入与建议的字数")
+    parser.add_argument("--rounds", type=int, default=20, help="每种实现的重复次数")
+    args = parser.parse_args()
+
+    text = ("现状分析：不良率由 3.2% 上升至 5.1%，主要集中在焊接工序。\n" * args.chars)[:args.chars]
+    user_inputs = {g["id"]: text for g in config.GUIDE}
+    suggestions = {g["id"]: text for g in config.GUIDE}
+
+    # 预热：加载 python-docx 默认模板并生成基础模板
+    A3.doc_to_bytes(legacy_render_doc("预热", user_inputs, suggestions))
+    A3.doc_to_bytes(A3.render_doc("预热", user_inputs, suggestions))
+
+    results = {
+        "legacy (per-run font)": timed(
+            lambda: A3.doc_to_bytes(legacy_render_doc("基准测试", user_inputs, suggestions)), args.rounds),
+        "template styles": timed(
+            lambda: A3.doc_to_bytes(A3.render_doc("基准测试", user_inputs, suggestions)), args.rounds),
+    }
+    print(f"{len(config.GUIDE)} 个步骤，每步 {args.chars} 字，重复 {args.rounds} 次")
+    for name, samples in results.items():
+        print(f"{name:<24} median {statistics.median(samples):8.2f} ms   min {min(samples):8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+本地压测
+========
+启动一个兼容 OpenAI `/chat/completions` 协议的本地桩服务（可配置延迟分布、流式输出和错误注入），
+把 config.DEEPSEEK_BASE_URL 指向它，再通过 Flask 测试客户端并发请求 /validate、/validate/stream 和 /generate，
+按场景统计吞吐（req/s）、p50/p95/p99 延迟和内存占用，结果写入 JSON 便于前后对比。
+全程不访问外网，也不消耗 API 额度。
+
+用法：
+  python benchmarks/loadtest.py [--scenarios validate,validate_stream,generate]
+                                [--requests 40] [--concurrency 8]
+                                [--latency lognormal:0.8,0.5] [--error-rate 0.02]
+                                [--output result.json] [--compare previous.json]
+
+延迟分布写法：fixed:<秒>、uniform:<最小>,<最大>、lognormal:<中位数>,<sigma>
+"""
+
+from __future__ import annotations
+import argparse
+import datetime as _dt
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+SCENARIOS = ("validate", "validate_stream", "generate")
+
+# 所有场景共用的请求序号，保证每个请求的内容都不同
+_sequence = itertools.count()
+
+# -------------------------------------------------------------
+# 桩服务
+
+def parse_latency(spec: str):
+    """把延迟分布描述解析成采样函数（单位：秒）"""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise argparse.ArgumentTypeError(f"无法识别的延迟分布：{spec}")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with server.lock:
+            server.calls += 1
+        time.sleep(server.latency())
+        if random.random() < server.error_rate:
+            self._send_json(random.choice((429, 500, 503)), {"error": {"message": "injected error"}})
+            return
+        text = "改进建议：" + "补充量化数据，明确因果关系。" * server.reply_repeat
+        usage = {"prompt_tokens": 200, "completion_tokens": 60, "total_tokens": 260}
+        if body.get("stream"):
+            self._send_stream(body, text, usage)
+        else:
+            self._send_json(200, {
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    def _send_json(self, status: int, payload) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, body, text: str, usage) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write(payload: bytes) -> None:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(payload), payload))
+
+        def chunk(delta, finish=None, extra=None):
+            payload = {
+                "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            payload.update(extra or {})
+            write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        step = max(1, len(text) // self.server.stream_chunks)
+        for start in range(0, len(text), step):
+            chunk({"content": text[start:start + step]})
+            time.sleep(self.server.chunk_delay)
+        chunk({}, "stop", {"usage": usage})
+        write(b"data: [DONE]\n\n")
+        write(b"")
+
+
+def start_stub(args) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", args.stub_port), StubHandler)
+    server.daemon_threads = True
+    server.latency = parse_latency(args.latency)
+    server.error_rate = args.error_rate
+    server.stream_chunks = args.stream_chunks
+    server.chunk_delay = args.chunk_delay
+    server.reply_repeat = 8
+    server.calls = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# -------------------------------------------------------------
+# 场景
+
+def new_client(app):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["access_granted"] = True
+    return client
+
+
+def unique_inputs(A3, seq: int):
+    """每个请求的内容都不同，避免命中响应缓存、任务去重和草稿复用
+
+    内容满足默认的本地预检规则（基线、目标、时间节点、责任人、前后对比），确保每次都会调用模型。
+    """
+    return {
+        g["id"]: (
+            f"#{seq} {g['title']}：产线不良率目前由 3.2% 上升至 5.1%，主要集中在焊接工序；"
+            "目标 6 月底前降到 2%，由张三负责，改善前后对比后更新 SOP。"
+        ) * 2
+        for g in A3.current_config().guide
+    }
+
+
+def run_validate(A3, client, seq: int) -> bool:
+    inputs = unique_inputs(A3, seq)
+    step_id = A3.current_config().guide[seq % len(A3.current_config().guide)]["id"]
+    resp = client.post("/validate", json={"step_id": step_id, "inputs": inputs, "history": []})
+    return resp.status_code == 200
+
+
+def run_validate_stream(A3, client, seq: int) -> bool:
+    inputs = unique_inputs(A3, seq)
+    step_id = A3.current_config().guide[seq % len(A3.current_config().guide)]["id"]
+    resp = client.post("/validate/stream", json={"step_id": step_id, "inputs": inputs, "history": []})
+    body = resp.get_data(as_text=True)
+    return resp.status_code == 200 and '"done": true' in body
+
+
+def run_generate(A3, client, seq: int) -> bool:
+    resp = client.post("/generate", data=unique_inputs(A3, seq))
+    if resp.status_code != 202:
+        return False
+    status_url = resp.get_json()["status_url"]
+    while True:
+        status = client.get(status_url).get_json()
+        if not status["generating"]:
+            break
+        time.sleep(0.05)
+    if status["status"] != "done":
+        return False
+    return client.get(status["download_url"]).status_code == 200
+
+
+RUNNERS = {
+    "validate": run_validate,
+    "validate_stream": run_validate_stream,
+    "generate": run_generate,
+}
+
+
+def percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def rss_mb():
+    """当前进程常驻内存（MB）；无法获取时返回 None"""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_scenario(A3, name: str, args, stub) -> dict:
+    runner = RUNNERS[name]
+    clients = threading.local()
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+
+    def one(_):
+        nonlocal failures
+        if not hasattr(clients, "client"):
+            clients.client = new_client(A3.app)
+        with lock:
+            seq = next(_sequence)
+        start = time.perf_counter()
+        try:
+            ok = runner(A3, clients.client, seq)
+        except Exception:
+            ok = False
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                failures += 1
+
+    calls_before = stub.calls
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - started
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "failures": failures,
+        "wall_s": round(wall, 3),
+        "rps": round(args.requests / wall, 2),
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "mean_ms": round(statistics.mean(latencies), 1),
+        "llm_calls": stub.calls - calls_before,
+        "rss_before_mb": rss_before,
+        "rss_after_mb": rss_mb(),
+    }
+
+
+def compare(previous_path: str, current: dict) -> None:
+    previous = json.loads(Path(previous_path).read_text(encoding="utf-8"))
+    print(f"\n与 {previous_path} 对比：")
+    for name, result in current["scenarios"].items():
+        old = previous.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        deltas = []
+        for key in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+            change = (result[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            deltas.append(f"{key} {old[key]} → {result[key]} ({change:+.1f}%)")
+        print(f"  {name:<16} " + "   ".join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="逗号分隔的场景列表")
+    parser.add_argument("--requests", type=int, default=40, help="每个场景的请求数")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发客户端数")
+    parser.add_argument("--latency", default="lognormal:0.8,0.5",
+                        help="桩服务单次调用的延迟分布")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入 429/5xx 错误的比例（0~1）")
+    parser.add_argument("--stream-chunks", type=int, default=20, help="流式回复拆分的片段数")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="流式片段之间的间隔（秒）")
+    parser.add_argument("--stub-port", type=int, default=18999, help="桩服务端口")
+    parser.add_argument("--output", help="结果 JSON 路径，默认 loadtest-<时间>.json")
+    parser.add_argument("--compare", help="与之前的结果 JSON 对比")
+    args = parser.parse_args()
+    try:
+        parse_latency(args.latency)
+    except argparse.ArgumentTypeError as exc:
+        parser.error(str(exc))
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in RUNNERS]
+    if unknown:
+        parser.error(f"未知场景：{', '.join(unknown)}")
+
+    stub = start_stub(args)
+    base_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    # 在导入 A3 之前设置：不写入真实输出目录，不复用响应缓存和相似步骤的建议
+    os.environ.update({
+        "DEEPSEEK_API_KEY": "loadtest",
+        "DEEPSEEK_BASE_URL": base_url,
+        "OUTPUT_DIR_NAME": tempfile.mkdtemp(prefix="a3-loadtest-"),
+        "LLM_CACHE_ENABLED": "false",
+        "SIMILARITY_THRESHOLD": "0",
+    })
+    import A3
+    import config
+    config.DEEPSEEK_BASE_URL = base_url
+
+    result = {
+        "timestamp": _dt.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "settings": {
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "stream_chunks": args.stream_chunks,
+            "chunk_delay": args.chunk_delay,
+            "LLM_MAX_CONCURRENCY": config.LLM_MAX_CONCURRENCY,
+            "REPORT_JOB_WORKERS": config.REPORT_JOB_WORKERS,
+            "LLM_POOL_MAX_CONNECTIONS": config.LLM_POOL_MAX_CONNECTIONS,
+        },
+        "scenarios": {},
+    }
+    print(f"桩服务 {base_url}，延迟 {args.latency}，错误率 {args.error_rate:.0%}")
+    for name in scenarios:
+        stats = run_scenario(A3, name, args, stub)
+        result["scenarios"][name] = stats
+        print(
+            f"{name:<16} {stats['rps']:7.2f} req/s   p50 {stats['p50_ms']:8.1f} ms   "
+            f"p95 {stats['p95_ms']:8.1f} ms   p99 {stats['p99_ms']:8.1f} ms   "
+            f"失败 {stats['failures']}/{stats['requests']}   LLM 调用 {stats['llm_calls']}   "
+            f"RSS {stats['rss_after_mb']} MB"
+        )
+
+    output = Path(args.output or f"loadtest-{_dt.datetime.now():%Y%m%d-%H%M%S}.json")
+    output.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"结果已写入 {output}")
+    if args.compare:
+        compare(args.compare, result)
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
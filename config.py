@@ -5,8 +5,8 @@ import os
 from pathlib import Path
 
 # 加载 .env 文件（如果存在）
-def load_env_file():
-    """加载 .env 文件中的环境变量"""
+def load_env_file(override=()):
+    """加载 .env 文件中的环境变量；override 中的配置项总是以 .env 为准"""
     env_path = Path(__file__).parent / '.env'
     if env_path.exists():
         with open(env_path, 'r', encoding='utf-8') as f:
@@ -17,13 +17,33 @@ def load_env_file():
                     key, value = line.split('=', 1)
                     key = key.strip()
                     value = value.strip()
-                    # 只有当环境变量未设置时才设置
-                    if key and not os.getenv(key):
+                    # 只有当环境变量未设置时才设置（override 中的除外）
+                    if key and (key in override or not os.getenv(key)):
                         os.environ[key] = value
 
 # 加载环境变量
 load_env_file()
 
+
+def env_int(name, default):
+    """读取整数配置；未设置、留空或格式错误时使用默认值，避免一个错误的值导致应用无法启动"""
+    value = os.getenv(name, "").strip()
+    try:
+        return int(value) if value else default
+    except ValueError:
+        print(f"警告: {name}={value!r} 不是有效的整数，使用默认值 {default}")
+        return default
+
+
+def env_float(name, default):
+    """读取数值配置，规则同 env_int"""
+    value = os.getenv(name, "").strip()
+    try:
+        return float(value) if value else default
+    except ValueError:
+        print(f"警告: {name}={value!r} 不是有效的数值，使用默认值 {default}")
+        return default
+
 # -------------------------------------------------------------
 # API Configuration
 # -------------------------------------------------------------
@@ -36,10 +56,64 @@ MODEL_NAME = os.getenv("MODEL_NAME", "deepseek-chat")
 # -------------------------------------------------------------
 APP_SECRET_KEY = os.getenv("APP_SECRET_KEY", "A3-Assistant-Secret")
 OUTPUT_DIR_NAME = os.getenv("OUTPUT_DIR_NAME", "output")
+STATE_DIR = os.getenv("STATE_DIR", "")  # SQLite 状态与缓存库目录（绝对路径或相对程序目录），留空则使用输出目录
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")  # 管理员密码
 WEB_ACCESS_PASSWORD = os.getenv("WEB_ACCESS_PASSWORD", "123456")  # 网页访问密码
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # /metrics 抓取令牌，留空则仅管理员登录后可访问
 HOST = os.getenv("HOST", "0.0.0.0")
-PORT = int(os.getenv("PORT", "9998"))
+PORT = env_int("PORT", 9998)
+WEB_SERVER = os.getenv("WEB_SERVER", "waitress").lower()  # python A3.py 使用的服务器：waitress（生产）/ uvicorn（异步，需安装 uvicorn a2wsgi）/ flask（开发调试）
+WEB_THREADS = env_int("WEB_THREADS", 16)  # 每个进程处理请求的线程数
+WEB_WORKERS = env_int("WEB_WORKERS", 2)  # gunicorn 工作进程数（见 gunicorn.conf.py）
+
+# -------------------------------------------------------------
+# Performance Configuration
+# -------------------------------------------------------------
+LLM_MAX_CONCURRENCY = env_int("LLM_MAX_CONCURRENCY", 8)  # 生成报告时同时进行的 LLM 调用上限
+LLM_TIMEOUT = env_float("LLM_TIMEOUT", 60)  # 单次 AI 请求超时（秒）
+LLM_DEADLINE = env_float("LLM_DEADLINE", 120)  # 含重试在内的总时限（秒）
+LLM_MAX_RETRIES = env_int("LLM_MAX_RETRIES", 2)  # 超时 / 连接失败 / 429 / 5xx 的最大重试次数
+LLM_RETRY_BASE_DELAY = env_float("LLM_RETRY_BASE_DELAY", 0.5)  # 指数退避的基础间隔（秒），实际间隔带随机抖动
+LLM_RETRY_MAX_DELAY = env_float("LLM_RETRY_MAX_DELAY", 8)  # 单次退避的最长间隔（秒）
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes", "on")  # 慢请求超过近期 p95 时补发一个相同请求（会增加调用量）
+LLM_HEDGE_MIN_DELAY = env_float("LLM_HEDGE_MIN_DELAY", 3)  # 补发请求前至少等待的秒数
+LLM_BREAKER_THRESHOLD = env_int("LLM_BREAKER_THRESHOLD", 5)  # 连续失败多少次后熔断，0 表示不熔断
+LLM_BREAKER_COOLDOWN = env_float("LLM_BREAKER_COOLDOWN", 30)  # 熔断后暂停调用的秒数
+LLM_GLOBAL_CONCURRENCY = env_int("LLM_GLOBAL_CONCURRENCY", 12)  # 所有功能合计同时进行的 AI 请求上限（每个进程）
+LLM_INTERACTIVE_RESERVED = env_int("LLM_INTERACTIVE_RESERVED", 2)  # 上述名额中只留给 AI 检查 / 追问的数量
+LLM_TOKENS_PER_MINUTE = env_int("LLM_TOKENS_PER_MINUTE", 0)  # 每分钟 token 上限（每个进程），0 表示不限制
+LLM_QUEUE_MAX = env_int("LLM_QUEUE_MAX", 50)  # AI 检查最多排队数，超过时直接提示繁忙，0 表示不限制
+LLM_QUEUE_TIMEOUT = env_float("LLM_QUEUE_TIMEOUT", 20)  # AI 检查最长排队时间（秒），0 表示不限制
+GENERATION_MODE = os.getenv("GENERATION_MODE", "per_step")  # 生成报告方式：per_step 逐步骤调用 / structured 一次调用生成所有步骤（可在管理后台切换）
+REPORT_JOB_WORKERS = env_int("REPORT_JOB_WORKERS", 4)  # 后台同时生成的报告数量
+REPORT_JOB_TTL = env_int("REPORT_JOB_TTL", 3600)  # 已完成任务保留时长（秒），过期后无法查询和下载
+REPORT_DEDUPE_TTL = env_int("REPORT_DEDUPE_TTL", 300)  # 相同内容在完成后多长时间内（秒）直接复用已生成的报告
+REPORT_PERSIST_MODE = os.getenv("REPORT_PERSIST_MODE", "async").lower()  # 报告落盘方式：sync 同步 / async 后台异步 / off 不保存
+REPORT_RETENTION_DAYS = env_int("REPORT_RETENTION_DAYS", 90)  # 报告保留天数，0 表示不按时间清理
+REPORT_RETENTION_MAX_MB = env_int("REPORT_RETENTION_MAX_MB", 1024)  # 报告总大小上限（MB），0 表示不限制
+DRAFT_TTL_DAYS = env_int("DRAFT_TTL_DAYS", 30)  # 服务端草稿（各步骤已生成的建议）保留天数
+BATCH_MAX_CONCURRENCY = env_int("BATCH_MAX_CONCURRENCY", 4)  # 批量生成时同时进行的 LLM 调用上限
+BATCH_RATE_PER_MINUTE = env_float("BATCH_RATE_PER_MINUTE", 60)  # 批量生成每分钟最多发起的 LLM 调用数，0 表示不限速
+BATCH_MAX_REPORTS = env_int("BATCH_MAX_REPORTS", 200)  # 单次批量生成的报告数量上限
+VALIDATE_TOKEN_BUDGET = env_int("VALIDATE_TOKEN_BUDGET", 6000)  # AI 检查 / 追问单次提示词的 token 预算（模型未单独配置时使用）
+SIMILARITY_THRESHOLD = env_float("SIMILARITY_THRESHOLD", 0.0)  # 步骤内容与以往生成过的内容（含其他用户）相似度（0~1）达到该值时直接复用当时的建议，默认 0 关闭（可在管理后台修改）
+SIMILARITY_MAX_ENTRIES = env_int("SIMILARITY_MAX_ENTRIES", 5000)  # 相似步骤索引最多保留的条目数
+CONVERSATION_TTL = env_int("CONVERSATION_TTL", 3600)  # AI 检查对话闲置多久（秒）后过期，过期后追问需重新检查
+CONVERSATION_MAX_ENTRIES = env_int("CONVERSATION_MAX_ENTRIES", 2000)  # 未开启 CONVERSATION_DISK 时内存中保留的对话数上限
+CONVERSATION_MAX_MESSAGES = env_int("CONVERSATION_MAX_MESSAGES", 40)  # 每个对话保存的消息条数上限（更早的丢弃）
+CONVERSATION_DISK = os.getenv("CONVERSATION_DISK", "true").lower() in ("1", "true", "yes", "on")  # 对话持久化到输出目录下的 SQLite（多进程部署时需开启）
+HISTORY_SUMMARY_TOKENS = env_int("HISTORY_SUMMARY_TOKENS", 400)  # 较早对话压缩成摘要后的 token 上限
+LLM_POOL_MAX_CONNECTIONS = env_int("LLM_POOL_MAX_CONNECTIONS", 20)  # 连接池最大连接数
+LLM_POOL_MAX_KEEPALIVE = env_int("LLM_POOL_MAX_KEEPALIVE", 10)  # 保持复用的空闲连接数
+LLM_POOL_KEEPALIVE_EXPIRY = env_float("LLM_POOL_KEEPALIVE_EXPIRY", 60)  # 空闲连接保留秒数
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "true").lower() in ("1", "true", "yes", "on")  # 安装 h2 后启用 HTTP/2
+LLM_PREWARM_CONNECT = os.getenv("LLM_PREWARM_CONNECT", "true").lower() in ("1", "true", "yes", "on")  # 启动时预先建立 AI 接口连接
+LLM_PREWARM_TIMEOUT = env_float("LLM_PREWARM_TIMEOUT", 5)  # 预热连接的超时（秒）
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes", "on")  # 相同请求复用 AI 回复
+LLM_CACHE_TTL = env_int("LLM_CACHE_TTL", 86400)  # 缓存有效期（秒）
+LLM_CACHE_MAX_ENTRIES = env_int("LLM_CACHE_MAX_ENTRIES", 512)  # 内存缓存条目上限
+LLM_CACHE_DISK = os.getenv("LLM_CACHE_DISK", "true").lower() in ("1", "true", "yes", "on")  # 是否持久化到输出目录下的 SQLite
+LLM_CACHE_DISK_MAX_ENTRIES = env_int("LLM_CACHE_DISK_MAX_ENTRIES", 5000)  # 磁盘缓存条目上限
 
 # -------------------------------------------------------------
 # Document Configuration
@@ -73,16 +147,15 @@ SYSTEM_PROMPTS = {
 
 
 请用简洁中文回复。""",
-    "validation": """以下是某 A3 报告已填写内容（可能不完整）：
-
-
-
-{context}
-
-
-
-请作为精益顾问，判断《{title}》段落是否符合该步骤的目的、工具及逻辑要求，若不充分，指出缺口并给出改进建议，总字数尽可能少。""",
-    "optimization": "请在不改变原意的情况下，优化下面这段《{title}》文本，使其更符合 A3 报告规范，输出 200 字以内改进建议：\n{content}"
+    "validation": """请作为精益顾问，判断《{title}》段落是否符合该步骤的目的、工具及逻辑要求，若不充分，指出缺口并给出改进建议，总字数尽可能少。
+
+以下是某 A3 报告已填写内容（可能不完整）：
+{context}""",
+    "optimization": "请在不改变原意的情况下，优化下面这段《{title}》文本，使其更符合 A3 报告规范，输出 200 字以内改进建议：\n{content}",
+    "structured": """请在不改变原意的情况下，逐段优化下面 A3 报告中已填写的各步骤文本，使其更符合 A3 报告规范，每个步骤输出 200 字以内改进建议。
+
+只输出一个 JSON 对象：键为方括号中的步骤ID，值为该步骤的改进建议（字符串），不要输出其它内容。
+{steps}"""
 }
 
 # -------------------------------------------------------------
@@ -147,6 +220,78 @@ GUIDE = [
     },
 ]
 
+# -------------------------------------------------------------
+# A3 Step Rules - 本地预检规则（AI 检查前执行，可在管理后台编辑）
+# -------------------------------------------------------------
+# min_length: 最少字数（不含空白），不足时直接提示补充，不调用 AI
+# require:    必须具备的要素，任一缺失时直接提示补充，不调用 AI
+# recommend:  建议具备的要素，缺失时仍调用 AI，并把缺失项附在提示词中
+# 要素格式为 {"name": 名称, "pattern": 正则表达式}，匹配不区分大小写
+STEP_RULES = {
+    "step1": {
+        "min_length": 4,
+        "recommend": [
+            {"name": "动词开头的课题名称（降低 / 提升 / 减少…）", "pattern": "降低|提升|提高|减少|缩短|消除|改善|优化|增加"},
+        ],
+    },
+    "step2": {
+        "min_length": 15,
+        "recommend": [
+            {"name": "量化数据", "pattern": "\\d"},
+            {"name": "预期收益", "pattern": "收益|效益|节约|节省|损失|成本|标杆"},
+        ],
+    },
+    "step3": {
+        "min_length": 15,
+        "recommend": [
+            {"name": "现状数据或占比", "pattern": "\\d|占比|比例"},
+        ],
+    },
+    "step4": {
+        "min_length": 8,
+        "require": [
+            {"name": "基线值（当前水平）", "pattern": "基线|现状|当前|目前|现在|从\\s*\\d"},
+            {"name": "目标值", "pattern": "目标|降至|降到|提升至|提高到|达到|到\\s*\\d"},
+            {"name": "具体数字", "pattern": "\\d"},
+        ],
+        "recommend": [
+            {"name": "完成期限", "pattern": "\\d+\\s*月|年底|月底|季度|Q\\d|\\d{4}"},
+        ],
+    },
+    "step5": {
+        "min_length": 15,
+        "recommend": [
+            {"name": "原因分析工具（鱼骨图 / 5Why 等）", "pattern": "鱼骨|5\\s*why|为什么|FMEA|头脑风暴|真因|根本原因|要因"},
+        ],
+    },
+    "step6": {
+        "min_length": 10,
+        "recommend": [
+            {"name": "对策与原因的对应关系", "pattern": "针对|对应|原因|真因"},
+            {"name": "责任或资源", "pattern": "负责|责任|资源|预算"},
+        ],
+    },
+    "step7": {
+        "min_length": 10,
+        "require": [
+            {"name": "时间节点", "pattern": "\\d+\\s*[月日号周]|\\d{4}[-/.年]|周[一二三四五六日]|月底|年底|截止|节点"},
+            {"name": "责任人", "pattern": "负责|责任人|主导|牵头|执行人|担当"},
+        ],
+        "recommend": [
+            {"name": "检查点", "pattern": "检查|跟踪|评审|复盘|确认"},
+        ],
+    },
+    "step8": {
+        "min_length": 10,
+        "require": [
+            {"name": "改善前后对比", "pattern": "前后|对比|改善前|改善后|之前|之后|从.*[降升到至]"},
+        ],
+        "recommend": [
+            {"name": "标准化（SOP / 作业指导书等）", "pattern": "SOP|标准|作业指导|规范|固化|制度"},
+        ],
+    },
+}
+
 # -------------------------------------------------------------
 # Model Options - 支持的模型列表
 # -------------------------------------------------------------
@@ -154,11 +299,13 @@ SUPPORTED_MODELS = {
     "deepseek-chat": {
         "name": "deepseek-chat",
         "display_name": "标准模式",
-        "description": "DeepSeek 标准聊天模型，适合日常对话和内容生成"
+        "description": "DeepSeek 标准聊天模型，适合日常对话和内容生成",
+        "validate_token_budget": VALIDATE_TOKEN_BUDGET,
     },
     "deepseek-reasoner": {
         "name": "deepseek-reasoner", 
         "display_name": "思考模式",
-        "description": "DeepSeek 推理模型，具备更强的逻辑推理和深度思考能力"
+        "description": "DeepSeek 推理模型，具备更强的逻辑推理和深度思考能力",
+        "validate_token_budget": VALIDATE_TOKEN_BUDGET,
     }
 } 
\ No newline at end of file
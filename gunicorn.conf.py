@@ -0,0 +1,32 @@
+# =============================================================
+# gunicorn 配置：gunicorn -c gunicorn.conf.py A3:app
+# =============================================================
+# 任务状态、去重键和限速计数保存在 STATE_DIR 下的 SQLite（WAL）中，
+# 多个工作进程或挂载同一本地状态目录的多个容器可以同时对外服务。
+import os
+
+import config
+
+bind = f"{config.HOST}:{config.PORT}"
+workers = max(1, config.WEB_WORKERS)
+threads = max(1, config.WEB_THREADS)
+worker_class = "gthread"
+# 流式输出和批量生成耗时较长，这里只限制工作进程心跳
+timeout = 120
+graceful_timeout = 30
+# 不预加载应用：线程池和 SQLite 连接都在各自的工作进程中创建
+preload_app = False
+accesslog = "-"
+
+
+def on_starting(server):
+    if not (os.getenv("DEEPSEEK_API_KEY") or config.DEEPSEEK_API_KEY):
+        print("错误: 未设置 DEEPSEEK_API_KEY 环境变量")
+        print("请在 .env 文件中设置 DEEPSEEK_API_KEY")
+        raise SystemExit(1)
+
+
+def post_worker_init(worker):
+    # 应用加载完成后在后台预热，预热结束前 /readyz 返回 503
+    import A3
+    A3.warmup.start()